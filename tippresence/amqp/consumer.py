@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from twisted.internet import defer
+from twisted.python import log
+
+from txamqp.queue import Closed
+
+from tippresence import PresenceError
+
+def debug(msg):
+    if __debug__:
+        log.msg(msg)
+
+class AMQConsumer(object):
+    queue_name = 'presence_updates'
+    channel_id = 2
+
+    def __init__(self, factory, presence_service, prefetch=500, batch_size=500):
+        factory.addCallbackOnConnected(self.start)
+        self.factory = factory
+        self.presence_service = presence_service
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.channel = None
+        self.stats_received = 0
+        self.stats_applied = 0
+        self.stats_invalid = 0
+        self.stats_failed = 0
+        self.stats_batches = 0
+
+    @defer.inlineCallbacks
+    def start(self, client):
+        debug("AMQP CONSUMER | Start consuming from queue %r (prefetch %r)." % (self.queue_name, self.prefetch))
+        channel = yield client.channel(self.channel_id)
+        yield channel.channel_open()
+        yield channel.basic_qos(prefetch_count=self.prefetch)
+        yield channel.queue_declare(queue=self.queue_name, durable=True)
+        reply = yield channel.basic_consume(queue=self.queue_name)
+        queue = yield client.queue(reply.consumer_tag)
+        self.channel = channel
+        yield self._consume(channel, queue)
+
+    @defer.inlineCallbacks
+    def _consume(self, channel, queue):
+        while True:
+            try:
+                msg = yield queue.get()
+                batch = [msg]
+                while queue.pending and len(batch) < self.batch_size:
+                    msg = yield queue.get()
+                    batch.append(msg)
+            except Closed:
+                debug("AMQP CONSUMER | Queue closed. Stop consuming.")
+                break
+            # delivery tags are per channel: settle the batch on the channel it came
+            # from, even if start() has opened a new one after a reconnect
+            yield self._applyBatch(channel, batch)
+
+    @defer.inlineCallbacks
+    def _applyBatch(self, channel, batch):
+        """Apply batch and settle its messages once the storage writes are done.
+
+        Applied and superseded updates are acked in bulk, invalid ones are
+        rejected and updates that failed to store are requeued.
+        """
+        self.stats_received += len(batch)
+        self.stats_batches += 1
+        updates = {}
+        untagged = []
+        acked = []
+        rejected = []
+        requeued = []
+        for msg in batch:
+            update = self._decode(msg.content.body)
+            if not update:
+                self.stats_invalid += 1
+                rejected.append(msg)
+                continue
+            resource, status, kw = update
+            if 'tag' in kw:
+                # only the latest update for the same presence matters
+                key = resource, kw['tag']
+                if key in updates:
+                    acked.append(updates[key][0])
+                updates[key] = (msg, update)
+            else:
+                untagged.append((msg, update))
+        applied = updates.values() + untagged
+        dl = []
+        for msg, (resource, status, kw) in applied:
+            dl.append(self.presence_service.put(resource, status, **kw))
+        results = yield defer.DeferredList(dl, consumeErrors=True)
+        for (msg, update), (success, result) in zip(applied, results):
+            if success:
+                self.stats_applied += 1
+                acked.append(msg)
+            elif result.check(PresenceError):
+                self.stats_invalid += 1
+                log.msg("AMQP CONSUMER | Invalid presence update %r: %s" % (msg.content.body, result.getErrorMessage()))
+                rejected.append(msg)
+            else:
+                self.stats_failed += 1
+                log.msg("AMQP CONSUMER | Failed to apply presence update %r, requeue: %s" %\
+                        (msg.content.body, result.getErrorMessage()))
+                requeued.append(msg)
+        # settle rejected messages first, so the bulk ack does not cover them
+        dl = [channel.basic_reject(delivery_tag=msg.delivery_tag, requeue=False) for msg in rejected]
+        dl += [channel.basic_reject(delivery_tag=msg.delivery_tag, requeue=True) for msg in requeued]
+        yield defer.gatherResults(dl)
+        if acked:
+            delivery_tag = max(msg.delivery_tag for msg in acked)
+            debug("AMQP CONSUMER | Applied batch of %d messages. Ack up to delivery tag %r." %\
+                    (len(batch), delivery_tag))
+            yield channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+
+    def _decode(self, body):
+        try:
+            resource, r = json.loads(body)
+            status = r['presence']['status']
+            kw = {}
+            if 'expires' in r:
+                kw['expires'] = int(r['expires'])
+            if 'priority' in r:
+                kw['priority'] = int(r['priority'])
+            if 'tag' in r:
+                kw['tag'] = r['tag']
+        except (ValueError, TypeError, KeyError), e:
+            log.msg("AMQP CONSUMER | Invalid presence update %r: %s" % (body, e))
+            return
+        return resource, status, kw
+
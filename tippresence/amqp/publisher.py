@@ -12,8 +12,21 @@ from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 import txamqp.spec
 
+from tippresence.utils import startup_timings
+
 SPECFILE = resource_filename(__name__, 'amqp0-8.xml')
 
+_specs = {}
+
+def load_spec(specfile=SPECFILE):
+    """Parse AMQP spec on first use, once per process."""
+    spec = _specs.get(specfile)
+    if spec is None:
+        startup_timings.start('amqp_spec_load')
+        spec = _specs[specfile] = txamqp.spec.load(specfile)
+        startup_timings.finish('amqp_spec_load')
+    return spec
+
 def debug(msg):
     if __debug__:
         log.msg(msg)
@@ -41,21 +54,38 @@ class AMQFactory(protocol.ReconnectingClientFactory):
 
     def __init__(self, creds):
         self.ConnectionDone = failure.Failure(error.ConnectionDone())
-        self.spec = txamqp.spec.load(SPECFILE)
         self.creds = creds
         self.client = None
         self.channel  = None
+        self._connected_callbacks = []
+        startup_timings.start('amqp_connect')
+
+    @property
+    def spec(self):
+        return load_spec()
+
+    def addCallbackOnConnected(self, callback, *args, **kwargs):
+        self._connected_callbacks.append((callback, args, kwargs))
 
     def buildProtocol(self, addr):
         self.resetDelay()
         delegate = TwistedDelegate()
         self.client = AMQClient(delegate=delegate, vhost=self.VHOST, spec=self.spec)
-        self.client.start(self.creds)
+        d = self.client.start(self.creds)
+        d.addCallback(self._clientStarted, self.client)
+        d.addErrback(log.err)
         if self.channel:
             self.channel.close(self.ConnectionDone)
             self.channel = None
         return self.client
 
+    def _clientStarted(self, _, client):
+        debug("AMQP | Connection to broker is established.")
+        startup_timings.finish('amqp_connect')
+        for callback, args, kwargs in self._connected_callbacks:
+            d = defer.maybeDeferred(callback, client, *args, **kwargs)
+            d.addErrback(log.err)
+
     @defer.inlineCallbacks
     def publish(self, exchange, msg, routing_key):
         if not self.client:
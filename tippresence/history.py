@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Last seen time and recent status history of resources, kept in memory.
+
+Every resource gets a slot in a set of flat typed arrays: SIZE (timestamp,
+status) entries of a ring buffer, the number of entries written and the last
+seen time. At most CAPACITY slots exist, the least recently changed resource
+gives its slot up to a new one. Changes come from PresenceService.watch(), so
+nothing is read from or written to storage on presence changes. The arrays are
+snapshotted to a file periodically and loaded back on start.
+"""
+
+import json
+import os
+import struct
+from array import array
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from tippresence import utils
+
+STATUS_GONE = -1
+STATUS_OFFLINE = 0
+STATUS_ONLINE = 1
+
+STATUS_NAMES = {
+    STATUS_GONE: 'gone',
+    STATUS_OFFLINE: 'offline',
+    STATUS_ONLINE: 'online',
+}
+
+SNAPSHOT_MAGIC = 'TPHIST1\n'
+SNAPSHOT_HEADER = struct.Struct('!III')
+
+def debug(msg):
+    if __debug__:
+        log.msg(msg)
+
+class PresenceHistory(object):
+    SIZE = 16
+    CAPACITY = 100000
+    SNAPSHOT_INTERVAL = 300
+
+    def __init__(self, presence_service, snapshot=None, size=None, capacity=None, clock=None, passive=False):
+        """snapshot is the file history is loaded from and periodically saved to.
+
+        History records changes of all resources, which makes the presence
+        service aggregate presence of every changed resource. A passive history
+        avoids that cost but records only resources somebody else watches (SIP
+        subscribers, AMQP publisher).
+        """
+        self.clock = clock or reactor
+        self.size = size or self.SIZE
+        self.capacity = capacity or self.CAPACITY
+        self.snapshot_file = snapshot
+        self._slots = OrderedDict()
+        self._times = array('d')
+        self._statuses = array('b')
+        self._writes = array('L')
+        self._last_seen = array('d')
+        self._snapshot_tid = None
+        self.stats_recorded = 0
+        self.stats_snapshots = 0
+        self.stats_evicted = 0
+        if snapshot and os.path.exists(snapshot):
+            try:
+                self.load(snapshot)
+            except (IOError, OSError, EOFError, ValueError, struct.error), e:
+                log.msg("HISTORY | Failed to load snapshot %r, start with empty history: %s" % (snapshot, e))
+        if snapshot:
+            self._snapshot_tid = self.clock.callLater(self.SNAPSHOT_INTERVAL, self._snapshotTimerCb)
+        presence_service.watch(self.presenceChanged, passive=passive)
+
+    def presenceChanged(self, resource, presence):
+        if presence is None:
+            status = STATUS_GONE
+        elif presence['status'] == 'online':
+            status = STATUS_ONLINE
+        else:
+            status = STATUS_OFFLINE
+        self.record(resource, status, self.clock.seconds())
+
+    def record(self, resource, status, ts):
+        slot = self._slots.pop(resource, None)
+        if slot is None:
+            slot = self._allocSlot()
+        self._slots[resource] = slot
+        writes = self._writes[slot]
+        if writes:
+            last = slot * self.size + (writes - 1) % self.size
+            if self._statuses[last] == status:
+                return
+            if self._statuses[last] == STATUS_ONLINE:
+                self._last_seen[slot] = ts
+        if status == STATUS_ONLINE:
+            self._last_seen[slot] = ts
+        pos = slot * self.size + writes % self.size
+        self._times[pos] = ts
+        self._statuses[pos] = status
+        self._writes[slot] = writes + 1
+        self.stats_recorded += 1
+
+    def get(self, resource):
+        """Return {'status', 'last_seen', 'history'} or None for unknown resource.
+
+        last_seen is the time the resource was last online (or went online, if
+        it is online now), history is a list of [timestamp, status], newest first.
+        """
+        slot = self._slots.get(resource)
+        if slot is None:
+            return None
+        writes = self._writes[slot]
+        history = []
+        for i in xrange(writes - 1, max(writes - self.size, 0) - 1, -1):
+            pos = slot * self.size + i % self.size
+            history.append([self._times[pos], STATUS_NAMES[self._statuses[pos]]])
+        last_seen = self._last_seen[slot] or None
+        return {'status': history[0][1], 'last_seen': last_seen, 'history': history}
+
+    def getMany(self, resources):
+        return dict((resource, self.get(resource)) for resource in resources)
+
+    def lastSeen(self, resource):
+        slot = self._slots.get(resource)
+        if slot is None:
+            return None
+        return self._last_seen[slot] or None
+
+    def memoryUsage(self):
+        arrays = (self._times, self._statuses, self._writes, self._last_seen)
+        return {
+            'slots': utils.container_usage(self._slots),
+            'arrays': {
+                'entries': len(self._writes),
+                'bytes': sum(a.buffer_info()[1] * a.itemsize for a in arrays),
+            },
+        }
+
+    def snapshot(self, path=None):
+        path = path or self.snapshot_file
+        debug("HISTORY | Snapshot %d resources to %r." % (len(self._slots), path))
+        resources = json.dumps(self._slots.items())
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(SNAPSHOT_HEADER.pack(self.size, len(self._writes), len(resources)))
+            f.write(resources)
+            for a in (self._times, self._statuses, self._writes, self._last_seen):
+                a.tofile(f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        self.stats_snapshots += 1
+
+    def load(self, path):
+        debug("HISTORY | Load snapshot %r." % path)
+        f = open(path, 'rb')
+        try:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("Not a history snapshot: %r" % path)
+            size, slots, header = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if size != self.size:
+                raise ValueError("History snapshot %r has size %d, expected %d" % (path, size, self.size))
+            if slots > self.capacity:
+                raise ValueError("History snapshot %r has %d slots, capacity is %d" % (path, slots, self.capacity))
+            resources = [(str(r), int(slot)) for r, slot in json.loads(f.read(header))]
+            times, statuses, writes, last_seen = array('d'), array('b'), array('L'), array('d')
+            times.fromfile(f, slots * size)
+            statuses.fromfile(f, slots * size)
+            writes.fromfile(f, slots)
+            last_seen.fromfile(f, slots)
+        finally:
+            f.close()
+        if any(slot >= slots for r, slot in resources):
+            raise ValueError("History snapshot %r is corrupt" % path)
+        self._slots = OrderedDict(resources)
+        self._times, self._statuses, self._writes, self._last_seen = times, statuses, writes, last_seen
+        debug("HISTORY | Loaded history of %d resources." % slots)
+
+    def stop(self):
+        if self._snapshot_tid and self._snapshot_tid.active():
+            self._snapshot_tid.cancel()
+        self._snapshot_tid = None
+        if self.snapshot_file:
+            self.snapshot()
+
+    def _allocSlot(self):
+        if len(self._writes) >= self.capacity:
+            resource, slot = self._slots.popitem(last=False)
+            debug("HISTORY | Capacity reached, reuse slot of %r." % resource)
+            self._writes[slot] = 0
+            self._last_seen[slot] = 0.0
+            self.stats_evicted += 1
+            return slot
+        slot = len(self._writes)
+        self._times.extend(array('d', [0.0]) * self.size)
+        self._statuses.extend(array('b', [0]) * self.size)
+        self._writes.append(0)
+        self._last_seen.append(0.0)
+        return slot
+
+    def _snapshotTimerCb(self):
+        self._snapshot_tid = self.clock.callLater(self.SNAPSHOT_INTERVAL, self._snapshotTimerCb)
+        try:
+            self.snapshot()
+        except (IOError, OSError), e:
+            log.msg("HISTORY | Snapshot failed: %s" % e)
@@ -2,4 +2,6 @@ from twisted.web import resource, server
 
 from stats import HTTPStats
 from presence import HTTPPresence
+from history import HTTPHistory
+from lists import HTTPResourceLists
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from twisted.web import resource
+
+from tippresence.http.presence import response, debug, authenticate
+
+class HTTPHistory(resource.Resource):
+    """Last seen and status history of resources.
+
+    GET /<resource>                          history of one resource
+    GET /?resource=<r1>&resource=<r2>...     history of several resources
+    POST / with JSON list of resources       same, for long lists
+
+    Covers every resource whose presence changed while history was running,
+    or only watched resources if the history is passive; the least recently
+    changed ones are dropped beyond its capacity. Requests for several
+    resources require authentication.
+    """
+    isLeaf = True
+
+    def __init__(self, history, users=None):
+        self.history = history
+        self.users = users or {}
+
+    def _filterPath(self, path):
+        return [x for x in path if x]
+
+    def render_GET(self, request):
+        debug("HTTP | Received history GET request: %r" % request)
+        path = self._filterPath(request.postpath)
+        if len(path) == 1:
+            r = self.history.get(path[0])
+            if r is None:
+                return response("failure", "Not Found")
+            return response("ok", "Success", r)
+        elif len(path) == 0:
+            if not authenticate(request, self.users):
+                return response("failure", "Authentication required")
+            return self._replyMany(request.args.get('resource', []))
+        return response("failure", "Invalid URI")
+
+    def render_POST(self, request):
+        debug("HTTP | Received history POST request: %r" % request)
+        if self._filterPath(request.postpath):
+            return response("failure", "Invalid URI")
+        if not authenticate(request, self.users):
+            return response("failure", "Authentication required")
+        try:
+            resources = json.load(request.content)
+        except ValueError, e:
+            return response("failure", str(e))
+        if not isinstance(resources, list):
+            return response("failure", "List of resources expected")
+        return self._replyMany(resources)
+
+    def _replyMany(self, resources):
+        return response("ok", "Success", self.history.getMany(resources))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from twisted.web import resource, server
+
+from tippresence.http.presence import response, debug, authenticate
+
+from twisted.python import log
+
+class HTTPResourceLists(resource.Resource):
+    """Resource lists SIP watchers subscribe to with eventlist support (RFC 4662).
+
+    GET /<list>                              members of the list
+    PUT /<list> with JSON list of resources  set members of the list
+    DELETE /<list>                           remove the list
+
+    All requests require authentication.
+    """
+    isLeaf = True
+
+    def __init__(self, sip_presence, users=None):
+        self.sip_presence = sip_presence
+        self.users = users or {}
+
+    def _filterPath(self, path):
+        return [x for x in path if x]
+
+    def render_GET(self, request):
+        debug("HTTP | Received resource list GET request: %r" % request)
+        if not authenticate(request, self.users):
+            return response("failure", "Authentication required")
+        path = self._filterPath(request.postpath)
+        if len(path) != 1:
+            return response("failure", "Invalid URI")
+        def reply(members):
+            if members is None:
+                request.write(response("failure", "Not Found"))
+            else:
+                request.write(response("ok", "Success", sorted(members)))
+            request.finish()
+        d = self.sip_presence.getResourceList(path[0])
+        d.addCallback(reply)
+        d.addErrback(self._replyError, request)
+        return server.NOT_DONE_YET
+
+    def render_PUT(self, request):
+        debug("HTTP | Received resource list PUT request: %r" % request)
+        if not authenticate(request, self.users):
+            return response("failure", "Authentication required")
+        path = self._filterPath(request.postpath)
+        if len(path) != 1:
+            return response("failure", "Invalid URI")
+        try:
+            members = json.load(request.content)
+        except ValueError, e:
+            return response("failure", str(e))
+        if not isinstance(members, list) or not all(isinstance(m, basestring) and m for m in members):
+            return response("failure", "List of resources expected")
+        members = [m.encode('utf-8') for m in members]
+        return self._reply(request, self.sip_presence.setResourceList(path[0], members))
+
+    def render_DELETE(self, request):
+        debug("HTTP | Received resource list DELETE request: %r" % request)
+        if not authenticate(request, self.users):
+            return response("failure", "Authentication required")
+        path = self._filterPath(request.postpath)
+        if len(path) != 1:
+            return response("failure", "Invalid URI")
+        return self._reply(request, self.sip_presence.removeResourceList(path[0]))
+
+    def _reply(self, request, d):
+        def reply(_):
+            request.write(response("ok", "Success"))
+            request.finish()
+        d.addCallback(reply)
+        d.addErrback(self._replyError, request)
+        return server.NOT_DONE_YET
+
+    def _replyError(self, failure, request):
+        log.err(failure, "HTTP | Resource list request failed.")
+        request.write(response("failure", "Failed"))
+        request.finish()
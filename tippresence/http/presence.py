@@ -6,6 +6,7 @@ from twisted.internet import defer
 from twisted.web import resource, server, http
 
 from tippresence import PresenceError
+from tippresence.trace import OP_PUT, OP_UPDATE, OP_REMOVE, OP_BULK_PUT, OP_BULK_UPDATE
 
 from twisted.python import log
 
@@ -19,11 +20,29 @@ def response(status='failure', reason='Failed', result=None):
     assert status in ['failure', 'ok']
     return json.dumps({'status': status, 'reason': reason, 'result': result})
 
+def authenticate(request, users):
+    if not users:
+        return 1
+    user, password = request.getUser(), request.getPassword()
+    if not user or not password:
+        log.msg("HTTP AUTH | Request without auth token")
+        request.setHeader('WWW-Authenticate', 'Basic realm="tippresence"')
+        request.setResponseCode(http.UNAUTHORIZED)
+        return
+    if user not in users:
+        log.msg("HTTP AUTH | User %r not found" % user)
+        return
+    if password != users[user]:
+        log.msg("HTTP AUTH | Invalid password for user %r" % user)
+        return
+    return 1
+
 class HTTPPresence(resource.Resource):
     isLeaf = True
-    def __init__(self, presence, users=None):
+    def __init__(self, presence, users=None, trace=None):
         self.presence = presence
         self.users = users or {}
+        self.trace = trace
 
     def _filterPath(self, path):
         return [x for x in path if x]
@@ -70,26 +89,16 @@ class HTTPPresence(resource.Resource):
         if not self.authenticate(request):
             return response("failure", "Authentication required")
         path = self._filterPath(request.postpath)
-        if path:
-            return response("failure", "Invalid URI")
-        return self.putAllStatuses(request, request.content)
+        if not path:
+            return self.putAllStatuses(request, request.content)
+        if path == ['refresh']:
+            return self.refreshAllPresence(request, request.content)
+        if len(path) == 3 and path[2] == 'refresh':
+            return self.refreshPresence(request, path[0], path[1])
+        return response("failure", "Invalid URI")
 
     def authenticate(self, request):
-        if not self.users:
-            return 1
-        user, password = request.getUser(), request.getPassword()
-        if not user or not password:
-            log.msg("HTTP AUTH | Request without auth token")
-            request.setHeader('WWW-Authenticate', 'Basic realm="tippresence"')
-            request.setResponseCode(http.UNAUTHORIZED)
-            return
-        if user not in self.users:
-            log.msg("HTTP AUTH | User %r not found" % user)
-            return
-        if password != self.users[user]:
-            log.msg("HTTP AUTH | Invalid password for user %r" % user)
-            return
-        return 1
+        return authenticate(request, self.users)
 
     def getPresence(self, request, resource):
         def reply(presence):
@@ -141,10 +150,65 @@ class HTTPPresence(resource.Resource):
         if 'expires' in r:
             kw['expires'] = int(r['expires'])
         d = self.presence.put(resource, status, **kw)
+        if self.trace:
+            self.trace.capture(d, OP_PUT, [resource, status, kw])
+        d.addCallback(reply)
+        d.addErrback(self._replyError, request)
+        return server.NOT_DONE_YET
+
+    def refreshPresence(self, request, resource, tag):
+        def reply(r):
+            if r:
+                request.write(response("ok", "Success"))
+            else:
+                request.write(response("failure", "Not Found"))
+            request.finish()
+
+        expires = self.presence.DEFAULT_EXPIRES
+        try:
+            if 'expires' in request.args:
+                expires = int(request.args['expires'][-1])
+        except ValueError, e:
+            return response("failure", "Invalid expires: " + str(e))
+        if expires <= 0:
+            return response("failure", "Invalid expires: %d" % expires)
+        d = self.presence.update(resource, tag, expires)
+        if self.trace:
+            self.trace.capture(d, OP_UPDATE, [resource, tag, expires])
         d.addCallback(reply)
         d.addErrback(self._replyError, request)
         return server.NOT_DONE_YET
 
+    def refreshAllPresence(self, request, content):
+        def reply(results):
+            not_found = [key for key, (success, r) in zip(keys, results) if not r]
+            if not_found:
+                request.write(response("failure", "Not Found", {'not_found': not_found}))
+            else:
+                request.write(response("ok", "Success"))
+            request.finish()
+
+        try:
+            docs = json.load(content)
+            refreshes = [(resource, tag, int(expires)) for (resource, tags) in docs.items()
+                    for (tag, expires) in tags.items()]
+        except (ValueError, AttributeError, TypeError), e:
+            return response("failure", "Invalid data: " + str(e))
+        for resource, tag, expires in refreshes:
+            if expires <= 0:
+                return response("failure", "Invalid expires: %d" % expires)
+        keys = []
+        dl = []
+        for resource, tag, expires in refreshes:
+            keys.append([resource, tag])
+            dl.append(self.presence.update(resource, tag, expires))
+        d = defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(reply)
+        d.addErrback(self._replyFirstError, request)
+        if self.trace:
+            self.trace.captureList(dl, OP_BULK_UPDATE, refreshes)
+        return server.NOT_DONE_YET
+
     def removePresence(self, request, resource, tag):
         def reply(r):
             if r:
@@ -154,6 +218,8 @@ class HTTPPresence(resource.Resource):
             request.finish()
 
         d = self.presence.remove(resource, tag)
+        if self.trace:
+            self.trace.capture(d, OP_REMOVE, [resource, tag])
         d.addCallback(reply)
         return server.NOT_DONE_YET
 
@@ -167,21 +233,29 @@ class HTTPPresence(resource.Resource):
         except ValueError, e:
             return response("failure", str(e))
         dl = []
+        puts = []
         for (resource, r) in docs.items():
             kw = {}
             #XXX: rework it
             status = r['presence']['status']
-            expires = int(r['expires'])
+            kw['expires'] = int(r['expires'])
             if 'priority' in r:
                 kw['priority'] = int(r['priority'])
             if 'tag' in r:
                 kw['tag'] = r['tag']
-            dl.append(self.presence.put(resource, status, expires, **kw))
+            dl.append(self.presence.put(resource, status, **kw))
+            puts.append([resource, status, kw])
         d = defer.DeferredList(dl, fireOnOneErrback=True)
         d.addCallback(reply)
-        d.addErrback(self._replyError, request)
+        d.addErrback(self._replyFirstError, request)
+        if self.trace:
+            self.trace.captureList(dl, OP_BULK_PUT, puts)
         return server.NOT_DONE_YET
 
+    def _replyFirstError(self, failure, request):
+        failure.trap(defer.FirstError)
+        return self._replyError(failure.value.subFailure, request)
+
     def _replyError(self, failure, request):
         failure.trap(PresenceError)
         msg = failure.getErrorMessage()
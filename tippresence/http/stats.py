@@ -5,20 +5,44 @@ import json
 from twisted.internet import defer
 from twisted.web import resource
 
+from tippresence.utils import startup_timings
+
 class HTTPStats(resource.Resource):
     isLeaf = True
 
-    def __init__(self, presence_service):
+    def __init__(self, presence_service, sip_presence=None, history=None):
         self.presence_service = presence_service
+        self.sip_presence = sip_presence
+        self.history = history
 
     def _dump(self):
         r = {}
         r['presence_put'] = self.presence_service.stats_put
+        r['presence_put_unchanged'] = self.presence_service.stats_put_unchanged
+        if self.presence_service.stats_put:
+            r['presence_put_unchanged_rate'] = float(self.presence_service.stats_put_unchanged) / self.presence_service.stats_put
+        else:
+            r['presence_put_unchanged_rate'] = 0.0
         r['presence_gotten'] = self.presence_service.stats_get
         r['presence_removed'] = self.presence_service.stats_remove
         r['presence_updated'] = self.presence_service.stats_update
         r['presence_dumped'] = self.presence_service.stats_dump
         r['active_presence'] = self.presence_service.stats_active_presence
+        r['presence_expired'] = self.presence_service.stats_expired
+        r['presence_expires_flushed'] = self.presence_service.stats_expires_flushed
+        memory = {}
+        for name, usage in self.presence_service.memoryUsage().iteritems():
+            memory['presence_' + name] = usage
+        if self.sip_presence:
+            for name, usage in self.sip_presence.memoryUsage().iteritems():
+                memory['sip_' + name] = usage
+        if self.history:
+            r['history_recorded'] = self.history.stats_recorded
+            r['history_snapshots'] = self.history.stats_snapshots
+            for name, usage in self.history.memoryUsage().iteritems():
+                memory['history_' + name] = usage
+        r['memory'] = memory
+        r['startup'] = startup_timings.dump()
         return r
 
     def render_GET(self, request):
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+
 from twisted.internet import reactor, defer
-from twisted.python import log
+from twisted.python import log, failure
 
 import utils
 
@@ -9,8 +11,8 @@ def debug(msg):
     if __debug__:
         log.msg(msg)
 
-def calc_expires_at(expires):
-    return reactor.seconds() + expires
+def calc_expires_at(expires, clock=reactor):
+    return clock.seconds() + expires
 
 class PresenceError(Exception):
     pass
@@ -19,30 +21,61 @@ class PresenceError(Exception):
 class PresenceService(object):
     MAX_EXPIRES = 3900
     DEFAULT_EXPIRES = 3600
+    EXPIRES_FLUSH_INTERVAL = 30
+    NOTIFIED_PRESENCE_LIMIT = None
+    RECOVER_CONCURRENCY = 100
     allowed_statuses = ["online", "offline"]
     _key_presence = "presence:%s:%s"
     _key_resource_presence = "resource_presence:%s"
     _key_resources = "resources"
 
-    def __init__(self, storage):
-        storage.addCallbackOnConnected(self._recoverExpireTimers)
+    def __init__(self, storage, clock=None, ttl_expiry=False):
+        """With ttl_expiry presence expiration is left to storage key TTLs.
+
+        The storage then has to provide expire(key, seconds) and
+        addCallbackOnExpired(callback), see storage.TTLMemoryStorage. No expire
+        timers are kept in process and nothing is recovered on start.
+
+        whenReady() fires once the storage is connected and expire timers are
+        recovered.
+        """
+        self._ready = utils.ReadyEvent()
+        if ttl_expiry:
+            storage.addCallbackOnExpired(self._keyExpired)
+            storage.addCallbackOnConnected(self._ready.fire)
+        else:
+            storage.addCallbackOnConnected(self._recoverExpireTimers)
         self.storage = storage
-        self._watch_callbacks = []
+        self.clock = clock or reactor
+        self.ttl_expiry = ttl_expiry
+        self._watch_callbacks = OrderedDict()
+        self._passive_callbacks = OrderedDict()
+        self._resource_watchers = {}
+        self._watch_resources = {}
+        self._watch_seq = 0
         self._expires_timers = {}
-        self._notified_presence = {}
+        self._notified_presence = OrderedDict()
+        self._pending_expires = {}
+        self._expires_flush_tid = None
+        self._sequencer = utils.KeySequencer()
+        self._notify_queued = set()
         self.stats_put = 0
         self.stats_update = 0
         self.stats_get = 0
         self.stats_remove = 0
         self.stats_dump = 0
         self.stats_active_presence = 0
+        self.stats_expires_flushed = 0
+        self.stats_expired = 0
+        self.stats_put_unchanged = 0
 
     @defer.inlineCallbacks
     def put(self, resource, status, expires=DEFAULT_EXPIRES, priority=0, tag=None, type=None):
         debug("PUT | %s:%s | Received put request: resource %r, status %r, expires %r, priority %r, tag %r, type %r" %\
                 (resource, tag, resource, status, expires, priority, tag, type))
         self.stats_put += 1
-        if not tag:
+        new_tag = not tag
+        if new_tag:
             tag = utils.random_str(10)
             debug("PUT | %s:%s | Generate tag for presence: %r." % (resource, tag, tag))
         if expires > self.MAX_EXPIRES:
@@ -54,8 +87,11 @@ class PresenceService(object):
                     (resource, tag, status, self.allowed_statuses))
             raise PresenceError("Unknown status value: %r. Allowed: %r" % (status, self.allowed_statuses))
         presence = {"resource": resource, "tag": tag, "status": status, "expires": expires, "priority": priority, "type": type}
-        yield self._storePresence(resource, tag, presence)
-        self._setExpireTimer(resource, tag, expires)
+        changed = yield self._sequencer.run((resource, tag), self._putPresence, resource, tag, presence, new_tag)
+        if not changed:
+            self.stats_put_unchanged += 1
+            debug("PUT | %s:%s | Presence unchanged, refreshed expires only." % (resource, tag))
+            defer.returnValue(tag)
         self._notifyWatchers(resource)
         debug("PUT | %s:%s | Put presence for resource %r with tag %r: %r" %\
                 (resource, tag, resource, tag, presence))
@@ -70,9 +106,13 @@ class PresenceService(object):
             debug("UPDATE | %s:%s | Max expires time exceeded. Requested %r, allowed %r. Raise exception." %\
                     (resource, tag, expires, self.MAX_EXPIRES))
             raise PresenceError("Expire limit exceeded")
-        r = yield self._updatePresenceExpires(resource, tag, expires)
-        if r:
+        if (resource, tag) not in self._sequencer and self._deferPresenceExpires(resource, tag, expires):
+            # nothing in flight for this presence, refresh in memory right away
             self._updateExpireTimer(resource, tag, expires)
+            r = 1
+        else:
+            r = yield self._sequencer.run((resource, tag), self._refreshPresence, resource, tag, expires)
+        if r:
             debug("UPDATE | %s:%s | Update presence for resource %r with tag %r: expires %r" %\
                     (resource, tag, resource, tag, expires))
             defer.returnValue(1)
@@ -119,9 +159,8 @@ class PresenceService(object):
         log.msg("REMOVE | %s:%s | Received remove request: resource %r, tag %r" %\
                 (resource, tag, resource, tag))
         self.stats_remove += 1
-        r = yield self._removePresence(resource, tag)
+        r = yield self._sequencer.run((resource, tag), self._dropPresence, resource, tag)
         if r:
-            self._cancelExpireTimer(resource, tag)
             self._notifyWatchers(resource)
             log.msg("REMOVE | %s:%s | Removed presence for resource %r with tag %r" %\
                     (resource, tag, resource, tag))
@@ -130,27 +169,168 @@ class PresenceService(object):
                 (resource, tag, resource, tag))
 
     def watch(self, callback, *args, **kwargs):
-        self._watch_callbacks.append((callback, args, kwargs))
+        """Call callback(resource, presence, *args, **kwargs) on presence changes.
+
+        Pass resource=<resource or iterable of resources> to watch only these
+        resources. With passive=True the callback gets changes of all resources
+        other watchers get, but doesn't make the service aggregate presence of
+        resources nobody else watches. Returns a handle for unwatch().
+        """
+        resources = kwargs.pop('resource', None)
+        passive = kwargs.pop('passive', False)
+        self._watch_seq += 1
+        handle = self._watch_seq
+        entry = (callback, args, kwargs)
+        if passive:
+            self._passive_callbacks[handle] = entry
+        elif resources is None:
+            self._watch_callbacks[handle] = entry
+        else:
+            if isinstance(resources, basestring):
+                resources = [resources]
+            resources = frozenset(resources)
+            for resource in resources:
+                self._resource_watchers.setdefault(resource, {})[handle] = entry
+        self._watch_resources[handle] = resources
+        return handle
+
+    def unwatch(self, handle):
+        if handle not in self._watch_resources:
+            return
+        resources = self._watch_resources.pop(handle)
+        if handle in self._passive_callbacks:
+            del self._passive_callbacks[handle]
+            return
+        if resources is None:
+            del self._watch_callbacks[handle]
+            return
+        for resource in resources:
+            watchers = self._resource_watchers[resource]
+            del watchers[handle]
+            if not watchers:
+                del self._resource_watchers[resource]
+
+    @defer.inlineCallbacks
+    def flushExpires(self):
+        if self._expires_flush_tid and self._expires_flush_tid.active():
+            self._expires_flush_tid.cancel()
+        self._expires_flush_tid = None
+        keys = self._pending_expires.keys()
+        debug("FLUSH | Flush %d deferred expires updates." % len(keys))
+        dl = []
+        for key in keys:
+            if key in self._sequencer:
+                dl.append(self._sequencer.run(key, self._flushPresenceExpires, *key))
+            else:
+                dl.append(self._flushPresenceExpires(*key))
+        yield defer.gatherResults(dl)
+        debug("FLUSH | Done.")
+
+    def whenReady(self):
+        return self._ready.wait()
+
+    def memoryUsage(self):
+        return {
+            'expires_timers': utils.container_usage(self._expires_timers),
+            'notified_presence': utils.container_usage(self._notified_presence),
+            'pending_expires': utils.container_usage(self._pending_expires),
+            'watch_callbacks': utils.container_usage(self._watch_callbacks),
+            'passive_callbacks': utils.container_usage(self._passive_callbacks),
+            'resource_watchers': utils.container_usage(self._resource_watchers),
+            'watch_resources': utils.container_usage(self._watch_resources),
+            'key_locks': utils.container_usage(self._sequencer.locks),
+            'notify_queued': utils.container_usage(self._notify_queued),
+        }
+
+    @defer.inlineCallbacks
+    def _putPresence(self, resource, tag, presence, new_tag=False):
+        tid = self._expires_timers.get((resource, tag))
+        # a freshly generated tag can't match stored presence
+        if not new_tag and (self.ttl_expiry or tid and tid.active()):
+            current = yield self._getPresence(resource, tag)
+            if current and self._samePresence(current, presence):
+                r = yield self._refreshPresence(resource, tag, presence['expires'])
+                if r:
+                    defer.returnValue(False)
+        yield self._storePresence(resource, tag, presence)
+        self._setExpireTimer(resource, tag, presence['expires'])
+        defer.returnValue(True)
+
+    def _samePresence(self, current, presence):
+        return current['status'] == presence['status'] and\
+                current['priority'] == int(presence['priority']) and\
+                str(current['type']) == str(presence['type'])
+
+    @defer.inlineCallbacks
+    def _refreshPresence(self, resource, tag, expires):
+        if self._deferPresenceExpires(resource, tag, expires):
+            self._updateExpireTimer(resource, tag, expires)
+            defer.returnValue(1)
+        r = yield self._updatePresenceExpires(resource, tag, expires)
+        if r:
+            self._setExpireTimer(resource, tag, expires)
+        defer.returnValue(r)
+
+    @defer.inlineCallbacks
+    def _dropPresence(self, resource, tag):
+        self._pending_expires.pop((resource, tag), None)
+        r = yield self._removePresence(resource, tag)
+        if r:
+            self._cancelExpireTimer(resource, tag)
+        defer.returnValue(r)
+
+    @defer.inlineCallbacks
+    def _flushPresenceExpires(self, resource, tag):
+        pending = self._pending_expires.get((resource, tag))
+        tid = self._expires_timers.get((resource, tag))
+        if not pending or not tid or not tid.active():
+            debug("FLUSH | %s:%s | Presence stored, expired or removed. Skip." % (resource, tag))
+            defer.returnValue(None)
+        yield self._writePresenceExpires(resource, tag, *pending)
+        if self._pending_expires.get((resource, tag)) is pending:
+            del self._pending_expires[resource, tag]
+        self.stats_expires_flushed += 1
 
     @defer.inlineCallbacks
     def _storePresence(self, resource, tag, presence):
         expires = presence['expires']
-        expires_at = calc_expires_at(expires)
+        expires_at = calc_expires_at(expires, self.clock)
         presence["expires_at"] = expires_at
+        self._pending_expires.pop((resource, tag), None)
         key = self._key_presence % (resource, tag)
         debug("STORE | %s:%s | Store presence %r for key %r" % (resource, tag, presence, key))
-        yield self.storage.hsetn(key, presence)
+        dl = [self.storage.hsetn(key, presence)]
+        if self.ttl_expiry:
+            dl.append(self.storage.expire(key, presence['expires']))
+        dl.append(self._sequencer.run(resource, self._addPresenceTag, resource, tag))
+        yield defer.gatherResults(dl)
+
+    def _addPresenceTag(self, resource, tag):
         resource_presence_key = self._key_resource_presence % resource
-        debug("STORE | %s:%s | Add tag %r to presence list (key %r)" %\
-                (resource, tag, tag, resource_presence_key))
-        yield self.storage.sadd(resource_presence_key, tag)
-        debug("STORE | %s:%s | Add resource %r to resources list (key %r)" %\
-                (resource, tag, resource, self._key_resources))
-        yield self.storage.sadd(self._key_resources, resource)
+        debug("STORE | %s:%s | Add tag %r to presence list (key %r) and resource to resources list (key %r)" %\
+                (resource, tag, tag, resource_presence_key, self._key_resources))
+        return defer.gatherResults([
+            self.storage.sadd(resource_presence_key, tag),
+            self.storage.sadd(self._key_resources, resource),
+            ])
+
+    def _deferPresenceExpires(self, resource, tag, expires):
+        if not self.EXPIRES_FLUSH_INTERVAL:
+            return
+        tid = self._expires_timers.get((resource, tag))
+        if not tid or not tid.active():
+            return
+        expires_at = calc_expires_at(expires, self.clock)
+        self._pending_expires[resource, tag] = (expires, expires_at)
+        if not self._expires_flush_tid:
+            self._expires_flush_tid = self.clock.callLater(self.EXPIRES_FLUSH_INTERVAL, self.flushExpires)
+        debug("STORE | %s:%s | Defer update of expires to %r (expires at %r)" %\
+                (resource, tag, expires, expires_at))
+        return 1
 
     @defer.inlineCallbacks
     def _updatePresenceExpires(self, resource, tag, expires):
-        expires_at = calc_expires_at(expires)
+        expires_at = calc_expires_at(expires, self.clock)
         key = self._key_presence % (resource, tag)
         try:
             yield self.storage.hget(key, "tag")
@@ -158,11 +338,17 @@ class PresenceService(object):
             debug("STORE | %s:%s | Caught KeyError exception from storage backend. Presence not found." %\
                     (resource, tag))
             defer.returnValue(None)
+        yield self._writePresenceExpires(resource, tag, expires, expires_at)
+        defer.returnValue(1)
+
+    def _writePresenceExpires(self, resource, tag, expires, expires_at):
+        key = self._key_presence % (resource, tag)
         debug("STORE | %s:%s | Update expires to %r (expires at %r) for key %r" %\
                 (resource, tag, expires, expires_at, key))
-        yield self.storage.hset(key, "expires", expires)
-        yield self.storage.hset(key, "expires_at", expires_at)
-        defer.returnValue(1)
+        dl = [self.storage.hset(key, "expires", expires), self.storage.hset(key, "expires_at", expires_at)]
+        if self.ttl_expiry:
+            dl.append(self.storage.expire(key, expires))
+        return defer.gatherResults(dl)
 
     @defer.inlineCallbacks
     def _getPresence(self, resource, tag):
@@ -172,6 +358,8 @@ class PresenceService(object):
             presence['expires'] = int(presence['expires'])
             presence['expires_at'] = float(presence['expires_at'])
             presence['priority'] = int(presence['priority'])
+            if (resource, tag) in self._pending_expires:
+                presence['expires'], presence['expires_at'] = self._pending_expires[resource, tag]
         except KeyError:
             debug("STORE | %s:%s | Caught KeyError exception for key %r. Presence not found." %\
                     (resource, tag, key))
@@ -193,20 +381,32 @@ class PresenceService(object):
     @defer.inlineCallbacks
     def _removePresence(self, resource, tag):
         key = self._key_presence % (resource, tag)
-        resource_presence_key = self._key_resource_presence % resource
         try:
             yield self.storage.hdrop(key)
         except KeyError:
             debug("STORE | %s:%s | Caught KeyError exception for key %r. Presence not found." %\
                     (resource, tag, key))
         else:
-            debug("STORE | %s:%s | Remove tag %r from presence list of resource %r." %\
-                    (resource, tag, tag, resource))
-            yield self.storage.srem(resource_presence_key, tag)
+            yield self._sequencer.run(resource, self._removePresenceTag, resource, tag)
             debug("STORE | %s:%s | Removed presence for resource %r with tag %r." %\
                     (resource, tag, resource, tag))
             defer.returnValue(1)
 
+    @defer.inlineCallbacks
+    def _removePresenceTag(self, resource, tag):
+        resource_presence_key = self._key_resource_presence % resource
+        debug("STORE | %s:%s | Remove tag %r from presence list of resource %r." %\
+                (resource, tag, tag, resource))
+        yield self.storage.srem(resource_presence_key, tag)
+        try:
+            tags = yield self.storage.sgetall(resource_presence_key)
+        except KeyError:
+            tags = None
+        if not tags:
+            debug("STORE | %s:%s | Last tag removed. Remove resource %r from resources list." %\
+                    (resource, tag, resource))
+            yield self.storage.srem(self._key_resources, resource)
+
     @defer.inlineCallbacks
     def _getAllPresence(self, resource):
         resource_presence_key = self._key_resource_presence % resource
@@ -224,6 +424,9 @@ class PresenceService(object):
             if not presence:
                 debug("STORE | %s | Faield to get presence for resource %r with tag %r." %\
                         (resource, resource, tag))
+                if self.ttl_expiry:
+                    # expiry event may have been missed while we were down
+                    self._keyExpired(self._key_presence % (resource, tag))
             else:
                 presence_list.append(presence)
         if presence_list:
@@ -232,75 +435,167 @@ class PresenceService(object):
             defer.returnValue(presence_list)
 
     def _setExpireTimer(self, resource, tag, expires):
+        if self.ttl_expiry:
+            return
         if (resource, tag) in self._expires_timers:
             self._updateExpireTimer(resource, tag, expires)
             return
-        tid = reactor.callLater(expires, self._expireTimerCb, resource, tag)
+        tid = self.clock.callLater(expires, self._expireTimerCb, resource, tag)
         self._expires_timers[resource, tag] = tid
         self.stats_active_presence += 1
         debug("TIMER | %s:%s | Timer is set to %r seconds" % (resource, tag, expires))
 
-    @defer.inlineCallbacks
     def _expireTimerCb(self, resource, tag):
         debug("TIMER | %s:%s | Executed presence expire callback. Remove expired presence." %\
                 (resource, tag))
+        tid = self._expires_timers.get((resource, tag))
+        return self._sequencer.run((resource, tag), self._expirePresence, resource, tag, tid)
+
+    @defer.inlineCallbacks
+    def _expirePresence(self, resource, tag, tid):
+        if self._expires_timers.get((resource, tag)) is not tid:
+            debug("TIMER | %s:%s | Presence refreshed or removed before expiration. Skip." % (resource, tag))
+            defer.returnValue(None)
+        self._pending_expires.pop((resource, tag), None)
         yield self._removePresence(resource, tag)
-        self._expires_timers.pop((resource, tag))
-        self._notifyWatchers(resource)
+        del self._expires_timers[resource, tag]
         self.stats_active_presence -= 1
+        self.stats_expired += 1
+        self._notifyWatchers(resource)
+
+    def _keyExpired(self, key):
+        prefix = self._key_presence.split('%s')[0]
+        if not key.startswith(prefix):
+            return
+        resource, tag = key[len(prefix):].rsplit(':', 1)
+        debug("TTL | %s:%s | Presence key %r expired in storage." % (resource, tag, key))
+        return self._sequencer.run((resource, tag), self._presenceKeyExpired, resource, tag)
+
+    @defer.inlineCallbacks
+    def _presenceKeyExpired(self, resource, tag):
+        key = self._key_presence % (resource, tag)
+        try:
+            yield self.storage.hget(key, "tag")
+        except KeyError:
+            pass
+        else:
+            debug("TTL | %s:%s | Presence stored again after expiration. Skip." % (resource, tag))
+            defer.returnValue(None)
+        try:
+            tags = yield self.storage.sgetall(self._key_resource_presence % resource)
+        except KeyError:
+            tags = None
+        if not tags or tag not in tags:
+            debug("TTL | %s:%s | Expired presence already cleaned up." % (resource, tag))
+            defer.returnValue(None)
+        yield self._sequencer.run(resource, self._removePresenceTag, resource, tag)
+        self.stats_expired += 1
+        self._notifyWatchers(resource)
 
     def _updateExpireTimer(self, resource, tag, expires):
+        if self.ttl_expiry:
+            return
         tid = self._expires_timers.get((resource, tag))
         if not tid:
             raise PresenceError("Timer not found. Update faield.")
-        tid.reset(expires)
+        if tid.active():
+            tid.reset(expires)
+        else:
+            # timer already fired, its expiration is queued behind us and skips a replaced timer
+            self._expires_timers[resource, tag] = self.clock.callLater(expires, self._expireTimerCb, resource, tag)
         debug("TIMER | %s:%s | Timer is updated to %r seconds." % (resource, tag, expires))
 
     def _cancelExpireTimer(self, resource, tag):
-        tid = self._expires_timers.get((resource, tag))
+        if self.ttl_expiry:
+            return
+        tid = self._expires_timers.pop((resource, tag), None)
         if not tid:
-            raise PresenceError("Timer not found. Cancel faield.")
-        tid.cancel()
-        self._expires_timers.pop((resource, tag))
+            debug("TIMER | %s:%s | Timer not found. Nothing to cancel." % (resource, tag))
+            return
+        if tid.active():
+            tid.cancel()
         self.stats_active_presence -= 1
         debug("TIMER | %s:%s | Timer is canceled." % (resource, tag))
 
     @defer.inlineCallbacks
     def _recoverExpireTimers(self):
         debug("TIMER_RECOVER | Recover timers..")
-        resources = yield self.storage.sgetall(self._key_resources)
+        utils.startup_timings.start('presence_timer_recovery')
+        try:
+            resources = yield self.storage.sgetall(self._key_resources)
+        except Exception:
+            f = failure.Failure()
+            log.err(f, "TIMER_RECOVER | Failed to load resources list.")
+            self._ready.fail(f)
+            defer.returnValue(None)
         debug("TIMER_RECOVER | Received resources list: %r." % resources)
+        # resources are independent, keep up to RECOVER_CONCURRENCY storage requests in flight
+        semaphore = defer.DeferredSemaphore(self.RECOVER_CONCURRENCY)
+        dl = []
         for resource in resources:
-            debug("TIMER_RECOVER | Recover timers for resource %r." % resource)
-            presence_list = yield self._getAllPresence(resource)
-            if not presence_list:
-                debug("TIMER_RECOVER | Presence for resource %r not found. Go ahead..." % resource)
-                continue
-            for presence in presence_list:
-                tag = presence['tag']
-                expires_at = presence['expires_at']
-                expires = expires_at - reactor.seconds()
-                debug("TIMER_RECOVER | Recover timer for resource %r with tag %r." % (resource, tag))
-                if expires < 0:
-                    debug("TIMER_RECOVER | Presence %r expired." % presence)
-                    expires = 0
-                self._setExpireTimer(resource, tag, expires)
+            d = semaphore.run(self._recoverResourceTimers, resource)
+            d.addErrback(log.err)
+            dl.append(d)
+        yield defer.DeferredList(dl)
+        utils.startup_timings.finish('presence_timer_recovery')
         debug("TIMER_RECOVER | Done.")
+        self._ready.fire()
 
     @defer.inlineCallbacks
+    def _recoverResourceTimers(self, resource):
+        debug("TIMER_RECOVER | Recover timers for resource %r." % resource)
+        presence_list = yield self._getAllPresence(resource)
+        if not presence_list:
+            debug("TIMER_RECOVER | Presence for resource %r not found. Go ahead..." % resource)
+            defer.returnValue(None)
+        dl = []
+        for presence in presence_list:
+            tag = presence['tag']
+            debug("TIMER_RECOVER | Recover timer for resource %r with tag %r." % (resource, tag))
+            if presence['expires_at'] <= self.clock.seconds():
+                debug("TIMER_RECOVER | Presence %r expired." % presence)
+                self._setExpireTimer(resource, tag, 0)
+                continue
+            # refreshes not flushed before a restart are lost, so stored expires_at
+            # may be up to a whole refresh behind: give live presence a full period
+            expires = presence['expires']
+            self._setExpireTimer(resource, tag, expires)
+            dl.append(self._writePresenceExpires(resource, tag, expires, calc_expires_at(expires, self.clock)))
+        yield defer.gatherResults(dl)
+
     def _notifyWatchers(self, resource):
+        if resource in self._notify_queued:
+            debug("NOTIFY | %s | Notification for resource %r already queued." % (resource, resource))
+            return defer.succeed(None)
+        self._notify_queued.add(resource)
+        return self._sequencer.run(resource, self._sendAggregatedPresence, resource)
+
+    @defer.inlineCallbacks
+    def _sendAggregatedPresence(self, resource):
+        self._notify_queued.discard(resource)
         debug("NOTIFY | %s | Notify watchers about resource %r presence." % (resource, resource))
+        if not self._watch_callbacks and resource not in self._resource_watchers:
+            debug("NOTIFY | %s | Nobody watches resource %r." % (resource, resource))
+            self._notified_presence.pop(resource, None)
+            defer.returnValue(None)
         presence = yield self._getAggregatedPresence(resource)
         if presence and presence == self._notified_presence.get(resource):
             debug("NOTIFY | %s | Watchers already notified about resource %r presence (%r)" %\
                     (resource, resource, presence))
             defer.returnValue(None)
-        else:
+        self._notified_presence.pop(resource, None)
+        if presence:
             self._notified_presence[resource] = presence
+            limit = self.NOTIFIED_PRESENCE_LIMIT
+            if limit and len(self._notified_presence) > limit:
+                self._notified_presence.popitem(last=False)
         self._sendPresence(resource, presence)
 
     def _sendPresence(self, resource, presence):
         debug("NOTIFY | %s | Send presence %r of resource %r to all watchers." % (resource, presence, resource))
-        for callback, arg, kw in self._watch_callbacks:
+        for callback, arg, kw in self._watch_callbacks.values() + self._passive_callbacks.values():
             callback(resource, presence, *arg, **kw)
+        if resource in self._resource_watchers:
+            for callback, arg, kw in self._resource_watchers[resource].values():
+                callback(resource, presence, *arg, **kw)
 
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""Replay a captured trace (see tippresence.trace) against a local PresenceService.
+
+Usage: python -m tippresence.replay presence.trace --speed max
+
+Subscriptions are replayed as resource watches plus the initial presence
+lookup, without SIP transactions and dialogs.
+"""
+
+import argparse
+import json
+import time
+
+from twisted.internet import defer, task
+
+from tipsip import MemoryStorage
+
+from tippresence import presence
+from tippresence.presence import PresenceService
+from tippresence.trace import read_trace, OPS, OP_PUT, OP_UPDATE, OP_REMOVE, OP_BULK_PUT,\
+        OP_BULK_UPDATE, OP_SUBSCRIBE
+
+MAX_EXAMPLES = 10
+
+BULK_OPS = {
+    OP_BULK_PUT: OP_PUT,
+    OP_BULK_UPDATE: OP_UPDATE,
+}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Replay(object):
+    def __init__(self, records, presence_service, speed=None, clock=None):
+        """speed is the time scale factor, None replays as fast as possible."""
+        self.records = sorted(records, key=lambda r: r[0])
+        self.presence = presence_service
+        self.speed = speed
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.tags = {}
+        self.watches = {}
+        self.latencies = []
+        self.ops = dict((name, 0) for name in OPS.itervalues())
+        self.divergences = 0
+        self.examples = []
+
+    @defer.inlineCallbacks
+    def run(self):
+        started = time.time()
+        if self.speed is None:
+            for record in self.records:
+                yield self._replay(*record)
+        elif self.records:
+            t0 = self.records[0][0]
+            dl = []
+            for record in self.records:
+                d = task.deferLater(self.clock, (record[0] - t0) / self.speed, self._replay, *record)
+                dl.append(d)
+            yield defer.DeferredList(dl)
+        defer.returnValue(self._report(time.time() - started))
+
+    @defer.inlineCallbacks
+    def _replay(self, ts, op, args, recorded):
+        started = time.time()
+        try:
+            result = yield self._dispatch(op, args, recorded)
+        except Exception, e:
+            result = {'error': str(e)}
+        self.latencies.append(time.time() - started)
+        self.ops[OPS[op]] += 1
+        if self._outcome(op, result) != self._outcome(op, recorded):
+            self.divergences += 1
+            if len(self.examples) < MAX_EXAMPLES:
+                self.examples.append({'op': OPS[op], 'args': args, 'recorded': recorded, 'replayed': result})
+
+    def _dispatch(self, op, args, recorded):
+        if op == OP_PUT:
+            return self._put(args, recorded)
+        if op == OP_UPDATE:
+            return self._update(args)
+        if op == OP_REMOVE:
+            resource, tag = args
+            return self.presence.remove(resource, self.tags.get((resource, tag), tag))
+        if op == OP_BULK_PUT:
+            return self._bulk(self._put, args, recorded)
+        if op == OP_BULK_UPDATE:
+            return self._bulk(self._update, args, [None] * len(args))
+        if op == OP_SUBSCRIBE:
+            return self._subscribe(args)
+        raise ValueError("Unknown trace operation %r" % op)
+
+    @defer.inlineCallbacks
+    def _put(self, args, recorded):
+        resource, status, kw = args
+        kw = dict((str(k), v) for k, v in kw.iteritems())
+        if 'tag' in kw:
+            kw['tag'] = self.tags.get((resource, kw['tag']), kw['tag'])
+        tag = yield self.presence.put(resource, status, **kw)
+        if 'tag' not in kw and isinstance(recorded, basestring):
+            self.tags[resource, recorded] = tag
+        defer.returnValue(tag)
+
+    def _update(self, args, recorded=None):
+        resource, tag, expires = args
+        return self.presence.update(resource, self.tags.get((resource, tag), tag), expires)
+
+    @defer.inlineCallbacks
+    def _bulk(self, f, args, recorded):
+        dl = [f(a, r) for a, r in zip(args, recorded)]
+        results = yield defer.DeferredList(dl, consumeErrors=True)
+        defer.returnValue([r if success else {'error': r.getErrorMessage()} for success, r in results])
+
+    @defer.inlineCallbacks
+    def _subscribe(self, args):
+        watcher, resource, expires = args
+        if not expires:
+            if watcher not in self.watches:
+                defer.returnValue(None)
+            self.presence.unwatch(self.watches.pop(watcher))
+        elif resource:
+            self.watches[watcher] = self.presence.watch(lambda r, p: None, resource=resource)
+            yield self.presence.get(resource)
+        elif watcher not in self.watches:
+            defer.returnValue(None)
+        defer.returnValue(1)
+
+    def _outcome(self, op, result):
+        if isinstance(result, dict) and 'error' in result:
+            return 'error'
+        if op in BULK_OPS:
+            return [self._outcome(BULK_OPS[op], r) for r in result]
+        if op == OP_PUT:
+            return 'ok'
+        return bool(result)
+
+    def _report(self, elapsed):
+        ms = lambda v: round(v * 1000, 3) if v is not None else None
+        return {
+            'operations': len(self.latencies),
+            'by_operation': self.ops,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_ops': round(len(self.latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': ms(percentile(self.latencies, 0.5)),
+                'p95': ms(percentile(self.latencies, 0.95)),
+                'p99': ms(percentile(self.latencies, 0.99)),
+                'max': ms(max(self.latencies) if self.latencies else None),
+                },
+            'divergences': self.divergences,
+            'divergence_examples': self.examples,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a presence trace against a local instance.")
+    parser.add_argument('trace')
+    parser.add_argument('--speed', default='max', help="time scale factor (1 = as captured) or 'max'")
+    args = parser.parse_args(argv)
+    speed = None if args.speed == 'max' else float(args.speed)
+    presence.debug = lambda msg: None
+
+    @defer.inlineCallbacks
+    def replay(reactor):
+        service = PresenceService(MemoryStorage())
+        report = yield Replay(read_trace(args.trace), service, speed, reactor).run()
+        print json.dumps(report, indent=4, sort_keys=True)
+    task.react(replay)
+
+if __name__ == '__main__':
+    main()
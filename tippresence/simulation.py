@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""Replay synthetic presence populations through PresenceService on a virtual clock.
+
+Usage: python -m tippresence.simulation --resources 100000 --tags 2 --days 1
+"""
+
+import argparse
+import heapq
+import json
+import random
+import time
+from resource import getrusage, RUSAGE_SELF
+
+from twisted.internet import error
+
+from tipsip import MemoryStorage
+
+from tippresence import presence
+from tippresence.presence import PresenceService
+
+
+class VirtualCall(object):
+    __slots__ = ('clock', 'time', 'seq', 'f', 'args', 'kw', 'cancelled', 'called')
+
+    def __init__(self, clock, time, f, args, kw):
+        self.clock = clock
+        self.time = time
+        self.seq = 0
+        self.f = f
+        self.args = args
+        self.kw = kw
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.clock.active -= 1
+
+    def reset(self, secondsFromNow):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.time = self.clock.seconds() + secondsFromNow
+        self.clock._push(self)
+
+
+class VirtualClock(object):
+    """IReactorTime provider for large simulations.
+
+    Same interface as twisted.internet.task.Clock, but keeps delayed calls in a
+    heap, so callLater() and reset() cost O(log n) instead of a full sort.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.active = 0
+        self.peak_active = 0
+        self._heap = []
+        self._seq = 0
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, f, *args, **kw):
+        call = VirtualCall(self, self.now + delay, f, args, kw)
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        self._push(call)
+        return call
+
+    def getDelayedCalls(self):
+        return [c for t, seq, c in self._heap if c.seq == seq and c.active()]
+
+    def advance(self, amount):
+        self.now += amount
+        heap = self._heap
+        while heap and heap[0][0] <= self.now:
+            t, seq, call = heapq.heappop(heap)
+            if call.seq != seq or not call.active():
+                continue
+            call.called = True
+            self.active -= 1
+            call.f(*call.args, **call.kw)
+
+    def _push(self, call):
+        self._seq += 1
+        call.seq = self._seq
+        heapq.heappush(self._heap, (call.time, call.seq, call))
+
+
+class Simulation(object):
+    """Synthetic population of presence clients.
+
+    Every (resource, tag) client publishes, refreshes after refresh * expires
+    seconds (with jitter), flips its status with probability `flap` on each
+    refresh and goes away without unpublishing with probability `drop`, coming
+    back after `away` seconds on average.
+    """
+
+    def __init__(self, resources=1000, tags=1, expires=3600, refresh=0.9, jitter=0.05,
+            flap=0.05, drop=0.01, away=3600, seed=0):
+        self.resources = resources
+        self.tags = tags
+        self.expires = expires
+        self.refresh = refresh
+        self.jitter = jitter
+        self.flap = flap
+        self.drop = drop
+        self.away = away
+        self.random = random.Random(seed)
+        self.clock = VirtualClock()
+        self.service = PresenceService(MemoryStorage(), clock=self.clock)
+        self.service.watch(self._presenceChanged)
+        self.notifications = 0
+        self.peak_presence_timers = 0
+
+    def run(self, days=1, step=60):
+        self.clock.advance(0)
+        for r in xrange(self.resources):
+            for t in xrange(self.tags):
+                start = self.random.uniform(0, self.expires * self.refresh)
+                self.clock.callLater(start, self._publish, 'user%d@simulation' % r, 'tag%d' % t, 'online')
+        cpu = time.clock()
+        wall = time.time()
+        duration = days * 86400
+        while self.clock.seconds() < duration:
+            self.clock.advance(step)
+            self.peak_presence_timers = max(self.peak_presence_timers, len(self.service._expires_timers))
+        return self._report(time.clock() - cpu, time.time() - wall)
+
+    def _interval(self):
+        interval = self.expires * self.refresh
+        return interval * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _publish(self, resource, tag, status):
+        self.service.put(resource, status, self.expires, tag=tag)
+        self.clock.callLater(self._interval(), self._refresh, resource, tag, status)
+
+    def _refresh(self, resource, tag, status):
+        r = self.random.random()
+        if r < self.drop:
+            self.clock.callLater(self.random.expovariate(1.0 / self.away), self._publish, resource, tag, status)
+        elif r < self.drop + self.flap:
+            status = 'offline' if status == 'online' else 'online'
+            self._publish(resource, tag, status)
+        else:
+            self.service.update(resource, tag, self.expires)
+            self.clock.callLater(self._interval(), self._refresh, resource, tag, status)
+
+    def _presenceChanged(self, resource, presence):
+        self.notifications += 1
+
+    def _report(self, cpu, wall):
+        s = self.service
+        return {
+            'virtual_seconds': self.clock.seconds(),
+            'cpu_seconds': round(cpu, 3),
+            'wall_seconds': round(wall, 3),
+            'peak_rss_kb': getrusage(RUSAGE_SELF).ru_maxrss,
+            'peak_timers': self.clock.peak_active,
+            'peak_presence_timers': self.peak_presence_timers,
+            'active_presence': s.stats_active_presence,
+            'notifications': self.notifications,
+            'put': s.stats_put,
+            'update': s.stats_update,
+            'remove': s.stats_remove,
+            'expired': s.stats_expired,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate presence churn on a virtual clock.")
+    parser.add_argument('--resources', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=1)
+    parser.add_argument('--expires', type=int, default=3600)
+    parser.add_argument('--refresh', type=float, default=0.9, help="refresh after this share of expires")
+    parser.add_argument('--flap', type=float, default=0.05, help="status change probability per refresh")
+    parser.add_argument('--drop', type=float, default=0.01, help="probability to vanish without unpublish")
+    parser.add_argument('--away', type=int, default=3600, help="mean time away after drop, seconds")
+    parser.add_argument('--days', type=float, default=1)
+    parser.add_argument('--step', type=int, default=60, help="clock step, seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    # per-operation debug logging dominates the profile otherwise
+    presence.debug = lambda msg: None
+    sim = Simulation(args.resources, args.tags, args.expires, args.refresh, flap=args.flap,
+            drop=args.drop, away=args.away, seed=args.seed)
+    report = sim.run(args.days, args.step)
+    print json.dumps(report, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
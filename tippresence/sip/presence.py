@@ -4,10 +4,16 @@ import re
 from collections import defaultdict
 
 from twisted.internet import reactor, defer
+from twisted.python import log, failure
 
 from tipsip import SIPUA, SIPError
 from tipsip.header import Header
 
+from tippresence.utils import container_usage, startup_timings, ReadyEvent
+from tippresence.trace import OP_PUT, OP_UPDATE, OP_REMOVE, OP_SUBSCRIBE
+
+
+RLMI_BOUNDARY = 'tippresence-rlmi-boundary'
 
 s2p = {
         'online':   'open',
@@ -32,6 +38,36 @@ def presence2pidf(resource, presence):
     a('</presence>')
     return '\n'.join(pidf)
 
+def presence2rlmi(list_uri, version, full_state, resources):
+    rlmi = []
+    a = rlmi.append
+    a('<?xml version="1.0" encoding="UTF-8"?>')
+    a('<list xmlns="urn:ietf:params:xml:ns:rlmi" uri="sip:%s" version="%d" fullState="%s">' %\
+            (list_uri, version, 'true' if full_state else 'false'))
+    for resource in resources:
+        a('\t<resource uri="sip:%s">' % resource)
+        a('\t\t<instance id="%s" state="active" cid="%s"/>' % (resource, resource))
+        a('\t</resource>')
+    a('</list>')
+    return '\n'.join(rlmi)
+
+def list2multipart(list_uri, version, full_state, presence_list):
+    parts = [(list_uri, 'application/rlmi+xml',
+        presence2rlmi(list_uri, version, full_state, [r for r, p in presence_list]))]
+    for resource, presence in presence_list:
+        parts.append((resource, 'application/pidf+xml', presence2pidf(resource, presence)))
+    body = []
+    a = body.append
+    for cid, content_type, content in parts:
+        a('--' + RLMI_BOUNDARY)
+        a('Content-Transfer-Encoding: binary')
+        a('Content-ID: <%s>' % cid)
+        a('Content-Type: %s' % content_type)
+        a('')
+        a(content)
+    a('--' + RLMI_BOUNDARY + '--')
+    return '\r\n'.join(body)
+
 
 class SIPPresence(SIPUA):
     DEFAULT_PUBLISH_EXPIRES = 3600
@@ -39,16 +75,35 @@ class SIPPresence(SIPUA):
     WATCHERS_SET_NAME = 'sys:watchers_by_resource:%s'
     RESOURCE_BY_WATCHER = 'sys:resource_by_watcher'
     WATCHER_TIMERS = 'sys:watcher_timers'
+    WATCHER_TTL_KEY = 'sys:watcher_ttl:%s'
+    RESOURCE_LIST = 'sys:resource_list:%s'
+    LISTS_BY_RESOURCE = 'sys:lists_by_resource:%s'
+    LIST_NOTIFY_INTERVAL = 2
 
     online_re = re.compile('.*<status><basic>open</basic></status>.*')
 
-    def __init__(self, storage, dialog_store, transport, transaction_layer, presence_service):
+    def __init__(self, storage, dialog_store, transport, transaction_layer, presence_service, clock=None, trace=None):
         SIPUA.__init__(self, dialog_store, transport, transaction_layer)
-        storage.addCallbackOnConnected(self._loadWatcherTimers)
+        self.ttl_expiry = presence_service.ttl_expiry
+        self._ready = ReadyEvent()
+        if self.ttl_expiry:
+            # no per-watcher state in process: watchers expire through storage TTLs
+            # and changes are matched against watchers in storage
+            storage.addCallbackOnExpired(self._keyExpired)
+            presence_service.watch(self.statusChangedCallback)
+            storage.addCallbackOnConnected(self._ready.fire)
+        else:
+            storage.addCallbackOnConnected(self._loadWatcherTimers)
         self.storage = storage
-        presence_service.watch(self.statusChangedCallback)
+        self.clock = clock or reactor
         self.presence_service = presence_service
+        self.trace = trace
         self.watcher_expires_tid = {}
+        self._watched_resources = {}
+        self._watcher_resources = {}
+        self._list_pending = {}
+        self._list_versions = {}
+        self._list_flush_tid = None
 
     @defer.inlineCallbacks
     def handle_PUBLISH(self, publish):
@@ -72,11 +127,13 @@ class SIPPresence(SIPUA):
             raise SIPError(423, 'Interval Too Brief')
 
         if expires == 0:
-            r = yield self.presence_service.remove(resource, tag)
+            d = self.presence_service.remove(resource, tag)
+            r = yield self._capture(d, OP_REMOVE, [resource, tag])
             if not r:
                 raise SIPError(412, 'Conditional Request Failed')
         elif tag:
-            r = yield self.presence_service.update(resource, tag, expires)
+            d = self.presence_service.update(resource, tag, expires)
+            r = yield self._capture(d, OP_UPDATE, [resource, tag, expires])
             if not r:
                 raise SIPError(412, 'Conditional Request Failed')
         else:
@@ -97,9 +154,18 @@ class SIPPresence(SIPUA):
             status = 'online'
         else:
             status = 'offline'
-        tag = yield self.presence_service.put(resource, status, expires, tag=tag, type="sip")
+        d = self.presence_service.put(resource, status, expires, tag=tag, type="sip")
+        kw = {'expires': expires, 'type': 'sip'}
+        if tag:
+            kw['tag'] = tag
+        tag = yield self._capture(d, OP_PUT, [resource, status, kw])
         defer.returnValue(tag)
 
+    def _capture(self, d, op, args):
+        if self.trace:
+            self.trace.capture(d, op, args)
+        return d
+
     @defer.inlineCallbacks
     def handle_SUBSCRIBE(self, subscribe):
         if subscribe.headers.get('Event') != 'presence':
@@ -111,60 +177,187 @@ class SIPPresence(SIPUA):
         else:
             yield self.processSubscription(subscribe)
 
-    @defer.inlineCallbacks
     def statusChangedCallback(self, resource, status):
+        self._resourceChanged(resource)
+        self._listChanged(resource)
+
+    @defer.inlineCallbacks
+    def _resourceChanged(self, resource):
         watchers = yield self._getResourceWatchers(resource)
         if not watchers:
             return
         for watcher in watchers:
-            self.notifyWatcher(watcher)
+            d = self.notifyWatcher(watcher)
+            d.addErrback(lambda f: f.trap(SIPError))
+            d.addErrback(log.err)
+
+    @defer.inlineCallbacks
+    def _listChanged(self, resource):
+        lists = yield self._getListsByResource(resource)
+        if not lists:
+            return
+        for list_uri in lists:
+            watchers = yield self._getResourceWatchers(list_uri)
+            if not watchers:
+                continue
+            for watcher in watchers:
+                self._list_pending.setdefault(watcher, set()).add(resource)
+        if self._list_pending and not self._list_flush_tid:
+            self._list_flush_tid = self.clock.callLater(self.LIST_NOTIFY_INTERVAL, self._flushListChanges)
+
+    def _flushListChanges(self):
+        self._list_flush_tid = None
+        pending, self._list_pending = self._list_pending, {}
+        for watcher, resources in pending.iteritems():
+            d = self.notifyListWatcher(watcher, sorted(resources))
+            d.addErrback(lambda f: f.trap(SIPError))
+            d.addErrback(log.err)
 
     @defer.inlineCallbacks
     def processSubscription(self, subscribe):
+        ts = self.clock.seconds()
         expires = int(subscribe.headers['Expires'])
+        resource = None
         if not expires and subscribe.dialog:
             watcher = subscribe.dialog.id
-            notify = yield self.createNotify(watcher, status='terminated', expires=0, dialog=subscribe.dialog)
+            notify = yield self.createWatcherNotify(watcher, status='terminated', expires=0, dialog=subscribe.dialog)
             yield self.removeWatcher(watcher)
         elif subscribe.dialog:
             watcher = subscribe.dialog.id
             yield self.updateWatcher(watcher, expires + 30)
-            notify = yield self.createNotify(watcher, status='active', expires=expires, dialog=subscribe.dialog)
+            notify = yield self.createWatcherNotify(watcher, status='active', expires=expires, dialog=subscribe.dialog)
         else:
             if not subscribe.ruri.user:
                 raise SIPError(404, 'Bad resource URI')
             resource = subscribe.ruri.user + '@' + subscribe.ruri.host
+            members = yield self._getResourceListMembers(resource)
+            if members is not None and not self._supportsEventList(subscribe):
+                raise SIPError(421, 'Extension Required')
             yield self.createDialog(subscribe)
             watcher = subscribe.dialog.id
             yield self.addWatcher(watcher, resource, expires + 30)
-            notify = yield self.createNotify(watcher, status='active', expires=expires, dialog=subscribe.dialog)
+            notify = yield self.createWatcherNotify(watcher, status='active', expires=expires, dialog=subscribe.dialog)
         response = subscribe.createResponse(200, 'OK')
         response.headers['Expires'] = str(expires)
         self.sendResponse(response)
+        if self.trace:
+            self.trace.record(OP_SUBSCRIBE, ts, [':'.join(watcher), resource, expires], 1)
         yield self.sendRequest(notify)
 
     @defer.inlineCallbacks
     def addWatcher(self, watcher, resource, expires):
         yield self._addResourceWatcher(resource, watcher)
         yield self._setWatcherTimer(watcher, expires)
+        yield self._watchResource(watcher, resource)
 
     @defer.inlineCallbacks
     def updateWatcher(self, watcher, expires):
-        if watcher not in self.watcher_expires_tid:
+        exists = yield self._hasWatcher(watcher)
+        if not exists:
             raise SIPError(500, "Server Internal Error")
         yield self._setWatcherTimer(watcher, expires)
 
     @defer.inlineCallbacks
     def removeWatcher(self, watcher):
-        if watcher not in self.watcher_expires_tid:
+        exists = yield self._hasWatcher(watcher)
+        if not exists:
             raise SIPError(404, 'Not Found')
-        resource = yield self._getResourceByWatcher(watcher)
-        yield self._removeResourceWatcher(resource, watcher)
-        yield self.removeDialog(id=watcher)
+        self._list_pending.pop(watcher, None)
+        self._list_versions.pop(watcher, None)
+        self._unwatchResource(watcher)
         yield self._cancelWatcherTimer(watcher)
+        yield self._purgeWatcher(watcher)
+
+    def whenReady(self):
+        """Fires once watchers are restored and the presence service is ready."""
+        return defer.gatherResults([self._ready.wait(), self.presence_service.whenReady()])
+
+    def memoryUsage(self):
+        return {
+            'watcher_timers': container_usage(self.watcher_expires_tid),
+            'watched_resources': container_usage(self._watched_resources),
+            'watcher_resources': container_usage(self._watcher_resources),
+            'list_pending': container_usage(self._list_pending),
+            'list_versions': container_usage(self._list_versions),
+        }
+
+    def getResourceList(self, list_uri):
+        """Return set of list members or None if there is no such list."""
+        return self._getResourceListMembers(list_uri)
 
     @defer.inlineCallbacks
-    def createNotify(self, watcher, pidf=None, dialog=None, status='active', expires=None):
+    def setResourceList(self, list_uri, members):
+        old_members = yield self._getResourceListMembers(list_uri)
+        old_members = old_members or set()
+        members = set(members)
+        if members == old_members:
+            return
+        s = self.RESOURCE_LIST % list_uri
+        for resource in old_members - members:
+            yield self.storage.srem(s, resource)
+            yield self.storage.srem(self.LISTS_BY_RESOURCE % resource, list_uri)
+        for resource in members - old_members:
+            yield self.storage.sadd(s, resource)
+            yield self.storage.sadd(self.LISTS_BY_RESOURCE % resource, list_uri)
+        for resource, resources in self._watcher_resources.itervalues():
+            if resource != list_uri:
+                continue
+            for r in members - resources:
+                self._retainResource(r)
+            for r in resources - members:
+                self._releaseResource(r)
+            resources.clear()
+            resources.update(members)
+        yield self._notifyListWatchers(list_uri, members)
+
+    @defer.inlineCallbacks
+    def removeResourceList(self, list_uri):
+        yield self.setResourceList(list_uri, [])
+
+    @defer.inlineCallbacks
+    def createWatcherNotify(self, watcher, dialog=None, status='active', expires=None):
+        resource = yield self._getResourceByWatcher(watcher)
+        members = yield self._getResourceListMembers(resource)
+        if members is None:
+            notify = yield self.createNotify(watcher, dialog=dialog, status=status, expires=expires)
+        else:
+            notify = yield self.createListNotify(watcher, resource, sorted(members), full_state=True,
+                    dialog=dialog, status=status, expires=expires)
+        defer.returnValue(notify)
+
+    @defer.inlineCallbacks
+    def createListNotify(self, watcher, list_uri, resources, full_state=False, dialog=None, status='active', expires=None):
+        presences = yield defer.gatherResults([self.presence_service.get(r) for r in resources])
+        presence_list = zip(resources, presences)
+        version = self._list_versions.get(watcher, 0)
+        self._list_versions[watcher] = version + 1
+        body = list2multipart(list_uri, version, full_state, presence_list)
+        content_type = 'multipart/related;type="application/rlmi+xml";start="<%s>";boundary="%s"' %\
+                (list_uri, RLMI_BOUNDARY)
+        notify = yield self.createNotify(watcher, body, dialog, status, expires, content_type)
+        notify.headers['require'] = 'eventlist'
+        defer.returnValue(notify)
+
+    @defer.inlineCallbacks
+    def _notifyListWatchers(self, list_uri, members):
+        watchers = yield self._getResourceWatchers(list_uri)
+        for watcher in watchers or []:
+            # full state supersedes changes pending for the watcher
+            self._list_pending.pop(watcher, None)
+            d = self.createListNotify(watcher, list_uri, sorted(members), full_state=True)
+            d.addCallback(self.sendRequest)
+            d.addErrback(lambda f: f.trap(SIPError))
+            d.addErrback(log.err)
+
+    @defer.inlineCallbacks
+    def notifyListWatcher(self, watcher, resources):
+        list_uri = yield self._getResourceByWatcher(watcher)
+        notify = yield self.createListNotify(watcher, list_uri, resources)
+        yield self.sendRequest(notify)
+
+    @defer.inlineCallbacks
+    def createNotify(self, watcher, pidf=None, dialog=None, status='active', expires=None,
+            content_type='application/pidf+xml'):
         if pidf is None:
             resource = yield self._getResourceByWatcher(watcher)
             presence = yield self.presence_service.get(resource)
@@ -174,12 +367,11 @@ class SIPPresence(SIPUA):
             if not dialog:
                 raise SIPError(500, "Server Internal Error")
         if expires is None:
-            expires = self.watcher_expires_tid[watcher].getTime() - reactor.seconds()
-            expires = int(expires)
+            expires = yield self._getWatcherExpires(watcher)
         notify = dialog.createRequest('NOTIFY')
         h = notify.headers
         h['subscription-state'] = Header(status, {'expires': str(expires)})
-        h['content-type'] = 'application/pidf+xml'
+        h['content-type'] = content_type
         h['Event'] = 'presence'
         notify.content = pidf
         defer.returnValue(notify)
@@ -199,6 +391,72 @@ class SIPPresence(SIPUA):
         r = [tuple(w.split(':')) for w in watchers]
         defer.returnValue(r)
 
+    @defer.inlineCallbacks
+    def _purgeWatcher(self, watcher):
+        try:
+            resource = yield self._getResourceByWatcher(watcher)
+        except KeyError:
+            resource = None
+        if resource:
+            yield self._removeResourceWatcher(resource, watcher)
+        yield self.removeDialog(id=watcher)
+
+    @defer.inlineCallbacks
+    def _getResourceListMembers(self, list_uri):
+        s = self.RESOURCE_LIST % list_uri
+        try:
+            members = yield self.storage.sgetall(s)
+        except KeyError:
+            defer.returnValue(None)
+        defer.returnValue(members or None)
+
+    @defer.inlineCallbacks
+    def _getListsByResource(self, resource):
+        s = self.LISTS_BY_RESOURCE % resource
+        try:
+            lists = yield self.storage.sgetall(s)
+        except KeyError:
+            defer.returnValue(None)
+        defer.returnValue(lists)
+
+    @defer.inlineCallbacks
+    def _watchResource(self, watcher, resource):
+        if self.ttl_expiry or watcher in self._watcher_resources:
+            return
+        members = yield self._getResourceListMembers(resource)
+        resources = set(members or [resource])
+        self._watcher_resources[watcher] = (resource, resources)
+        for r in resources:
+            self._retainResource(r)
+
+    def _unwatchResource(self, watcher):
+        if watcher not in self._watcher_resources:
+            return
+        resource, resources = self._watcher_resources.pop(watcher)
+        for r in resources:
+            self._releaseResource(r)
+
+    def _retainResource(self, resource):
+        if resource in self._watched_resources:
+            self._watched_resources[resource][1] += 1
+        else:
+            handle = self.presence_service.watch(self.statusChangedCallback, resource=resource)
+            self._watched_resources[resource] = [handle, 1]
+
+    def _releaseResource(self, resource):
+        w = self._watched_resources[resource]
+        w[1] -= 1
+        if not w[1]:
+            self.presence_service.unwatch(w[0])
+            del self._watched_resources[resource]
+
+    def _supportsEventList(self, request):
+        for name in ('supported', 'require'):
+            value = request.headers.get(name)
+            if value and 'eventlist' in [x.strip() for x in str(value).split(',')]:
+                return True
+        return False
+
     @defer.inlineCallbacks
     def _addResourceWatcher(self, resource, watcher):
         w = ':'.join(watcher)
@@ -219,19 +477,73 @@ class SIPPresence(SIPUA):
         r = yield self.storage.hget(self.RESOURCE_BY_WATCHER, w)
         defer.returnValue(r)
 
+    @defer.inlineCallbacks
+    def _hasWatcher(self, watcher):
+        if not self.ttl_expiry:
+            defer.returnValue(watcher in self.watcher_expires_tid)
+        expiresat = yield self._getWatcherExpiresAt(watcher)
+        defer.returnValue(expiresat is not None)
+
+    @defer.inlineCallbacks
+    def _getWatcherExpires(self, watcher):
+        if self.ttl_expiry:
+            expiresat = yield self._getWatcherExpiresAt(watcher)
+            if expiresat is None:
+                raise SIPError(481, 'Call/Transaction Does Not Exist')
+        else:
+            expiresat = self.watcher_expires_tid[watcher].getTime()
+        defer.returnValue(int(expiresat - self.clock.seconds()))
+
+    @defer.inlineCallbacks
+    def _getWatcherExpiresAt(self, watcher):
+        """Return expiration time of watcher in TTL mode or None if it is gone.
+
+        Watchers whose TTL key expired while nobody received expiry events
+        (process down, lost keyspace notification) are purged here.
+        """
+        w = ':'.join(watcher)
+        try:
+            expiresat = yield self.storage.hget(self.WATCHER_TIMERS, w)
+        except KeyError:
+            defer.returnValue(None)
+        expiresat = float(expiresat)
+        if expiresat > self.clock.seconds():
+            defer.returnValue(expiresat)
+        log.msg("SIP | Purge stale watcher %r, expired at %r." % (w, expiresat))
+        self._list_pending.pop(watcher, None)
+        self._list_versions.pop(watcher, None)
+        yield self._cancelWatcherTimer(watcher)
+        yield self._purgeWatcher(watcher)
+        defer.returnValue(None)
+
     @defer.inlineCallbacks
     def _setWatcherTimer(self, watcher, delay, memonly=False):
+        if self.ttl_expiry:
+            w = ':'.join(watcher)
+            key = self.WATCHER_TTL_KEY % w
+            yield self.storage.hset(self.WATCHER_TIMERS, w, self.clock.seconds() + delay)
+            yield self.storage.hset(key, 'watcher', w)
+            yield self.storage.expire(key, delay)
+            return
         if watcher in self.watcher_expires_tid:
             self.watcher_expires_tid[watcher].reset(delay)
         else:
-            self.watcher_expires_tid[watcher] = reactor.callLater(delay, self.removeWatcher, watcher)
+            self.watcher_expires_tid[watcher] = self.clock.callLater(delay, self.removeWatcher, watcher)
         if not memonly:
             w = ':'.join(watcher)
-            expiresat = reactor.seconds() + delay
+            expiresat = self.clock.seconds() + delay
             yield self.storage.hset(self.WATCHER_TIMERS, w, expiresat)
 
     @defer.inlineCallbacks
     def _cancelWatcherTimer(self, watcher):
+        if self.ttl_expiry:
+            w = ':'.join(watcher)
+            yield self.storage.hdel(self.WATCHER_TIMERS, w)
+            try:
+                yield self.storage.hdrop(self.WATCHER_TTL_KEY % w)
+            except KeyError:
+                pass
+            defer.returnValue(None)
         if watcher not in self.watcher_expires_tid:
             defer.returnValue(None)
         w = ':'.join(watcher)
@@ -240,17 +552,47 @@ class SIPPresence(SIPUA):
         if tid.active():
             tid.cancel()
 
+    def _keyExpired(self, key):
+        prefix = self.WATCHER_TTL_KEY.split('%s')[0]
+        if not key.startswith(prefix):
+            return
+        watcher = tuple(key[len(prefix):].split(':'))
+        d = self.removeWatcher(watcher)
+        d.addErrback(lambda f: f.trap(SIPError))
+        d.addErrback(log.err)
+        return d
+
     @defer.inlineCallbacks
     def _loadWatcherTimers(self):
+        startup_timings.start('sip_watcher_timers')
         try:
             timers = yield self.storage.hgetall(self.WATCHER_TIMERS)
         except KeyError:
+            timers = {}
+        except Exception:
+            f = failure.Failure()
+            log.err(f, "SIP | Failed to load watcher timers.")
+            self._ready.fail(f)
             defer.returnValue(None)
+        semaphore = defer.DeferredSemaphore(self.presence_service.RECOVER_CONCURRENCY)
+        dl = []
         for w, expiresat in timers.iteritems():
-            expires = float(expiresat) - reactor.seconds()
-            if expires <= 0:
-                yield self.storage.hdel(self.WATCHER_TIMERS, w)
-            else:
-                watcher = tuple(w.split(':'))
-                yield self._setWatcherTimer(watcher, expires, memonly=True)
+            d = semaphore.run(self._loadWatcherTimer, w, expiresat)
+            d.addErrback(log.err)
+            dl.append(d)
+        yield defer.DeferredList(dl)
+        startup_timings.finish('sip_watcher_timers')
+        self._ready.fire()
+
+    @defer.inlineCallbacks
+    def _loadWatcherTimer(self, w, expiresat):
+        expires = float(expiresat) - self.clock.seconds()
+        watcher = tuple(w.split(':'))
+        if expires <= 0:
+            yield self.storage.hdel(self.WATCHER_TIMERS, w)
+            yield self._purgeWatcher(watcher)
+        else:
+            yield self._setWatcherTimer(watcher, expires, memonly=True)
+            resource = yield self._getResourceByWatcher(watcher)
+            yield self._watchResource(watcher, resource)
 
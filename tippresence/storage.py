@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor, defer
+
+from tipsip.storage import MemoryStorage
+
+class TTLMemoryStorage(MemoryStorage):
+    """MemoryStorage with key TTLs and expiry events.
+
+    In-memory stand-in for a backend with native key expiry (Redis EXPIRE and
+    keyspace 'expired' events), used by the TTL expiry mode of PresenceService
+    and SIPPresence.
+    """
+
+    def __init__(self, clock=None):
+        MemoryStorage.__init__(self)
+        self.clock = clock or reactor
+        self._ttl_timers = {}
+        self._expired_callbacks = []
+
+    def addCallbackOnExpired(self, callback, *args, **kwargs):
+        self._expired_callbacks.append((callback, args, kwargs))
+
+    @defer.inlineCallbacks
+    def expire(self, table, seconds):
+        try:
+            yield MemoryStorage.hgetall(self, table)
+        except KeyError:
+            defer.returnValue(0)
+        tid = self._ttl_timers.get(table)
+        if tid and tid.active():
+            tid.reset(seconds)
+        else:
+            self._ttl_timers[table] = self.clock.callLater(seconds, self._expireTable, table)
+        defer.returnValue(1)
+
+    def hdrop(self, table):
+        tid = self._ttl_timers.pop(table, None)
+        if tid and tid.active():
+            tid.cancel()
+        return MemoryStorage.hdrop(self, table)
+
+    @defer.inlineCallbacks
+    def _expireTable(self, table):
+        del self._ttl_timers[table]
+        try:
+            yield MemoryStorage.hdrop(self, table)
+        except KeyError:
+            defer.returnValue(None)
+        for callback, args, kwargs in self._expired_callbacks:
+            callback(table, *args, **kwargs)
@@ -0,0 +1,158 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+import json
+
+from txamqp.queue import TimeoutDeferredQueue
+
+from tippresence import PresenceError
+from tippresence.amqp import AMQConsumer
+
+class FakeContent(object):
+    def __init__(self, body):
+        self.body = body
+
+class FakeMessage(object):
+    def __init__(self, delivery_tag, body):
+        self.delivery_tag = delivery_tag
+        self.content = FakeContent(body)
+
+class FakeReply(object):
+    consumer_tag = 'consumer'
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acks = []
+        self.rejects = []
+        self.prefetch = None
+
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+        return defer.succeed(None)
+
+    def queue_declare(self, queue, durable):
+        return defer.succeed(None)
+
+    def basic_consume(self, queue):
+        return defer.succeed(FakeReply())
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acks.append((delivery_tag, multiple))
+        return defer.succeed(None)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejects.append((delivery_tag, requeue))
+        return defer.succeed(None)
+
+class FakeBroker(object):
+    def __init__(self):
+        self.chan = FakeChannel()
+        self.q = TimeoutDeferredQueue()
+        self.delivery_tag = 0
+
+    def channel(self, id):
+        return defer.succeed(self.chan)
+
+    def queue(self, key):
+        return defer.succeed(self.q)
+
+    def deliver(self, body):
+        self.delivery_tag += 1
+        self.q.put(FakeMessage(self.delivery_tag, body))
+
+class FakeFactory(object):
+    def addCallbackOnConnected(self, callback):
+        self.callback = callback
+
+class FakePresenceService(object):
+    def __init__(self):
+        self.puts = []
+        self.pending = []
+
+    def put(self, resource, status, **kw):
+        self.puts.append((resource, status, kw))
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def storeAll(self):
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.callback(None)
+
+def update(resource, status, **kw):
+    kw['presence'] = {'status': status}
+    return json.dumps([resource, kw])
+
+class AMQConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.factory = FakeFactory()
+        self.presence = FakePresenceService()
+        self.consumer = AMQConsumer(self.factory, self.presence, prefetch=10, batch_size=10)
+        self.consumed = self.factory.callback(self.broker)
+
+    def tearDown(self):
+        self.broker.q.close()
+        return self.consumed
+
+    def test_batchAck(self):
+        self.assertEqual(self.broker.chan.prefetch, 10)
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'online', tag='amqp'))
+        self.assertEqual(len(self.presence.puts), 1)
+        for i in range(5):
+            self.broker.deliver(update('user%d@tipmeet.com' % i, 'online', expires=60))
+        self.assertEqual(self.broker.chan.acks, [])
+        self.presence.storeAll()
+        self.assertEqual(self.broker.chan.acks, [(1, True)])
+        self.assertEqual(len(self.presence.puts), 6)
+        self.assertEqual(self.presence.puts[-1][2], {'expires': 60})
+        self.presence.storeAll()
+        self.assertEqual(self.broker.chan.acks, [(1, True), (6, True)])
+        self.assertEqual(self.consumer.stats_batches, 2)
+        self.assertEqual(self.consumer.stats_applied, 6)
+
+    def test_coalesceAndInvalid(self):
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'online', tag='amqp'))
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'offline', tag='amqp'))
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'online', tag='amqp'))
+        self.broker.deliver('garbage')
+        self.presence.storeAll()
+        self.presence.storeAll()
+        self.assertEqual(len(self.presence.puts), 2)
+        self.assertEqual(self.presence.puts[1][:2], ('ivaxer@tipmeet.com', 'online'))
+        self.assertEqual(self.consumer.stats_invalid, 1)
+        self.assertEqual(self.broker.chan.acks, [(1, True), (3, True)])
+        self.assertEqual(self.broker.chan.rejects, [(4, False)])
+
+    def test_putFailure(self):
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'online', tag='amqp'))
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'busy', tag='amqp'))
+        self.broker.deliver(update('john@tipmeet.com', 'online', tag='amqp'))
+        self.broker.deliver(update('bob@tipmeet.com', 'online', tag='amqp'))
+        self.presence.storeAll()
+        puts = dict((resource, d) for (resource, status, kw), d in zip(self.presence.puts[1:], self.presence.pending))
+        d1, d2, d3 = puts['ivaxer@tipmeet.com'], puts['john@tipmeet.com'], puts['bob@tipmeet.com']
+        self.presence.pending = []
+        d1.errback(PresenceError("Invalid status"))
+        d2.errback(KeyError('storage'))
+        self.assertEqual(self.broker.chan.acks, [(1, True)])
+        d3.callback(None)
+        self.assertEqual(sorted(self.broker.chan.rejects), [(2, False), (3, True)])
+        self.assertEqual(self.broker.chan.acks, [(1, True), (4, True)])
+        self.assertEqual(self.consumer.stats_invalid, 1)
+        self.assertEqual(self.consumer.stats_failed, 1)
+        self.assertEqual(self.consumer.stats_applied, 2)
+
+    def test_ackOnBatchChannel(self):
+        self.broker.deliver(update('ivaxer@tipmeet.com', 'online', tag='amqp'))
+        broker = FakeBroker()
+        consumed = self.consumer.start(broker)
+        self.presence.storeAll()
+        self.assertEqual(self.broker.chan.acks, [(1, True)])
+        self.assertEqual(broker.chan.acks, [])
+        broker.q.close()
+        return consumed
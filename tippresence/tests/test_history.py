@@ -0,0 +1,119 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+from StringIO import StringIO
+
+from tipsip import MemoryStorage
+from tippresence import PresenceService
+from tippresence.history import PresenceHistory
+from tippresence.http import HTTPHistory
+
+class PresenceHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.presence = PresenceService(MemoryStorage(), clock=self.clock)
+        self.history = PresenceHistory(self.presence, size=4, clock=self.clock)
+
+    def test_history(self):
+        self.assertEqual(self.history.get('ivaxer@tipmeet.com'), None)
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        self.clock.advance(10)
+        self.presence.put('ivaxer@tipmeet.com', 'offline', expires=60, tag='sip')
+        self.clock.advance(10)
+        self.presence.remove('ivaxer@tipmeet.com', 'sip')
+        h = self.history.get('ivaxer@tipmeet.com')
+        self.assertEqual(h, {'status': 'gone', 'last_seen': 10,
+            'history': [[20, 'gone'], [10, 'offline'], [0, 'online']]})
+
+    def test_ring(self):
+        for i in xrange(7):
+            self.history.record('ivaxer@tipmeet.com', i % 2, i)
+        self.history.record('ivaxer@tipmeet.com', 0, 7)
+        h = self.history.get('ivaxer@tipmeet.com')
+        self.assertEqual(h['history'], [[6, 'offline'], [5, 'online'], [4, 'offline'], [3, 'online']])
+        self.assertEqual(h['last_seen'], 6)
+        self.assertEqual(self.history.memoryUsage()['arrays']['entries'], 1)
+
+    def test_passive(self):
+        self.presence.unwatch(max(self.presence._watch_callbacks))
+        history = PresenceHistory(self.presence, size=4, clock=self.clock, passive=True)
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        self.assertEqual(history.get('ivaxer@tipmeet.com'), None)
+        self.presence.watch(lambda r, p: None, resource='ivaxer@tipmeet.com')
+        self.presence.put('ivaxer@tipmeet.com', 'offline', expires=60, tag='sip')
+        self.assertEqual(history.get('ivaxer@tipmeet.com')['status'], 'offline')
+
+    def test_capacity(self):
+        history = PresenceHistory(self.presence, size=4, capacity=2, clock=self.clock)
+        history.record('ivaxer@tipmeet.com', 1, 1)
+        history.record('john@tipmeet.com', 1, 2)
+        history.record('ivaxer@tipmeet.com', 0, 3)
+        history.record('bob@tipmeet.com', 1, 4)
+        self.assertEqual(history.get('john@tipmeet.com'), None)
+        self.assertEqual(history.get('bob@tipmeet.com'), {'status': 'online', 'last_seen': 4, 'history': [[4, 'online']]})
+        self.assertEqual(history.lastSeen('ivaxer@tipmeet.com'), 3)
+        self.assertEqual(history.stats_evicted, 1)
+        self.assertEqual(history.memoryUsage()['arrays']['entries'], 2)
+        path = self.mktemp()
+        history.snapshot(path)
+        loaded = PresenceHistory(self.presence, size=4, capacity=2, clock=self.clock)
+        loaded.load(path)
+        self.assertEqual(loaded.get('ivaxer@tipmeet.com')['history'], [[3, 'offline'], [1, 'online']])
+        loaded.record('alice@tipmeet.com', 1, 5)
+        self.assertEqual(loaded.get('ivaxer@tipmeet.com'), None)
+        self.assertEqual(loaded.lastSeen('bob@tipmeet.com'), 4)
+        self.assertRaises(ValueError, PresenceHistory(self.presence, size=4, capacity=1).load, path)
+
+    def test_badSnapshot(self):
+        path = self.mktemp()
+        self.history.record('ivaxer@tipmeet.com', 1, 5)
+        self.history.snapshot(path)
+        data = open(path, 'rb').read()
+        for broken in [data[:len(data) - 4], data[:10], 'garbage']:
+            open(path, 'wb').write(broken)
+            history = PresenceHistory(self.presence, snapshot=path, size=4, clock=self.clock)
+            history.stop()
+            self.assertEqual(history.get('ivaxer@tipmeet.com'), None)
+            self.assertEqual(history.memoryUsage()['arrays']['entries'], 0)
+
+    def test_snapshot(self):
+        path = self.mktemp()
+        self.history.record('ivaxer@tipmeet.com', 1, 5)
+        self.history.record('john@tipmeet.com', 0, 6)
+        self.history.snapshot(path)
+        history = PresenceHistory(self.presence, size=4, clock=self.clock)
+        history.load(path)
+        self.assertEqual(history.getMany(['ivaxer@tipmeet.com', 'john@tipmeet.com']),
+                self.history.getMany(['ivaxer@tipmeet.com', 'john@tipmeet.com']))
+        history.record('bob@tipmeet.com', 1, 7)
+        self.assertEqual(history.lastSeen('bob@tipmeet.com'), 7)
+        self.assertRaises(ValueError, PresenceHistory(self.presence, size=8).load, path)
+
+    def test_http(self):
+        http = HTTPHistory(self.history, {'guest': 'guest'})
+        self.history.record('ivaxer@tipmeet.com', 1, 5)
+
+        def request(method, path, args=None, body='', user='guest', password='guest'):
+            request = DummyRequest(path)
+            request.method = method
+            request.args = args or {}
+            request.content = StringIO(body)
+            request.getUser = lambda: user
+            request.getPassword = lambda: password
+            return json.loads(http.render(request))
+
+        r = request('GET', [''], {'resource': ['ivaxer@tipmeet.com']}, user=None)
+        self.assertEqual(r['reason'], 'Authentication required')
+        r = request('POST', [''], body=json.dumps(['ivaxer@tipmeet.com']), password='secret')
+        self.assertEqual(r['reason'], 'Authentication required')
+        r = request('GET', ['ivaxer@tipmeet.com'], user=None)
+        self.assertEqual(r['result']['history'], [[5, 'online']])
+        r = request('GET', ['john@tipmeet.com'])
+        self.assertEqual(r['reason'], 'Not Found')
+        r = request('GET', [''], {'resource': ['ivaxer@tipmeet.com', 'john@tipmeet.com']})
+        self.assertEqual(r['result']['john@tipmeet.com'], None)
+        self.assertEqual(r['result']['ivaxer@tipmeet.com']['last_seen'], 5)
+        r = request('POST', [''], body=json.dumps(['ivaxer@tipmeet.com']))
+        self.assertEqual(r['result'].keys(), ['ivaxer@tipmeet.com'])
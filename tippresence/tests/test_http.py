@@ -0,0 +1,61 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+from StringIO import StringIO
+
+from tipsip import MemoryStorage
+from tippresence import PresenceService
+from tippresence.http import HTTPPresence
+
+class HTTPPresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.presence = PresenceService(MemoryStorage(), clock=task.Clock())
+        self.http = HTTPPresence(self.presence)
+
+    def post(self, path, body='', args=None):
+        request = DummyRequest(path)
+        request.method = 'POST'
+        request.content = StringIO(body)
+        request.args = args or {}
+        result = self.http.render(request)
+        if isinstance(result, str):
+            return json.loads(result)
+        return json.loads(''.join(request.written))
+
+    @defer.inlineCallbacks
+    def test_refresh(self):
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='http')
+        r = self.post(['ivaxer@tipmeet.com', 'http', 'refresh'], args={'expires': ['120']})
+        self.assertEqual(r['status'], 'ok')
+        p = yield self.presence.get('ivaxer@tipmeet.com', 'http')
+        self.assertEqual(p['expires'], 120)
+        r = self.post(['ivaxer@tipmeet.com', 'unknown', 'refresh'])
+        self.assertEqual(r['reason'], 'Not Found')
+        r = self.post(['ivaxer@tipmeet.com', 'http', 'refresh'], args={'expires': ['100000']})
+        self.assertEqual(r['status'], 'failure')
+        for expires in ('0', '-10'):
+            r = self.post(['ivaxer@tipmeet.com', 'http', 'refresh'], args={'expires': [expires]})
+            self.assertEqual(r['reason'], 'Invalid expires: %s' % expires)
+        p = yield self.presence.get('ivaxer@tipmeet.com', 'http')
+        self.assertEqual(p['expires'], 120)
+
+    @defer.inlineCallbacks
+    def test_refreshAll(self):
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='http')
+        yield self.presence.put('john@tipmeet.com', 'online', expires=60, tag='http')
+        body = json.dumps({'ivaxer@tipmeet.com': {'http': 120, 'gone': 120}, 'john@tipmeet.com': {'http': 90}})
+        r = self.post(['refresh'], body)
+        self.assertEqual(r['reason'], 'Not Found')
+        self.assertEqual(r['result'], {'not_found': [['ivaxer@tipmeet.com', 'gone']]})
+        for body in ({'a': {'t': None}}, {'a': {'t': [60]}}, ['a']):
+            r = self.post(['refresh'], json.dumps(body))
+            self.assertEqual(r['status'], 'failure')
+        body = json.dumps({'ivaxer@tipmeet.com': {'http': 90}, 'john@tipmeet.com': {'http': 0}})
+        r = self.post(['refresh'], body)
+        self.assertEqual(r['reason'], 'Invalid expires: 0')
+        p = yield self.presence.get('ivaxer@tipmeet.com', 'http')
+        self.assertEqual(p['expires'], 120)
+        p = yield self.presence.get('john@tipmeet.com', 'http')
+        self.assertEqual(p['expires'], 90)
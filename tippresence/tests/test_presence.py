@@ -1,10 +1,11 @@
 from twisted.trial import unittest
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 
 import json
 
 from tipsip import MemoryStorage
-from tippresence import PresenceService
+from tippresence import PresenceService, utils
+from tippresence.storage import TTLMemoryStorage
 
 class PresenceServerTest(unittest.TestCase):
     def setUp(self):
@@ -65,3 +66,327 @@ class PresenceServerTest(unittest.TestCase):
         d.addCallback(self.assertEqual, 0)
         yield d
 
+
+
+class DelayedStorage(object):
+    def __init__(self, storage, clock, delay):
+        self.storage = storage
+        self.clock = clock
+        self.delay = delay
+
+    def addCallbackOnConnected(self, callback, *args, **kwargs):
+        self.storage.addCallbackOnConnected(callback, *args, **kwargs)
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        def delayed(*args):
+            d = defer.Deferred()
+            self.clock.callLater(self.delay, method(*args).chainDeferred, d)
+            return d
+        return delayed
+
+
+class PresenceServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.presence = PresenceService(self.storage)
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        return d
+
+    def tearDown(self):
+        for tid in self.presence._expires_timers.values():
+            if tid.active():
+                tid.cancel()
+        if self.presence._expires_flush_tid and self.presence._expires_flush_tid.active():
+            self.presence._expires_flush_tid.cancel()
+
+    @defer.inlineCallbacks
+    def test_updateWriteBehind(self):
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        stored = yield self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        r = yield self.presence.update('ivaxer@tipmeet.com', 'sip', 120)
+        self.assertEqual(r, 1)
+        s = yield self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        self.assertEqual(s, stored)
+        p = yield self.presence.get('ivaxer@tipmeet.com', 'sip')
+        self.assertEqual(p['expires'], 120)
+        yield self.presence.flushExpires()
+        s = yield self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        self.assertEqual(int(s['expires']), 120)
+        self.assertEqual(self.presence.stats_expires_flushed, 1)
+
+    @defer.inlineCallbacks
+    def test_removeDropsDeferredExpires(self):
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        yield self.presence.update('ivaxer@tipmeet.com', 'sip', 120)
+        yield self.presence.remove('ivaxer@tipmeet.com', 'sip')
+        yield self.presence.flushExpires()
+        d = self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        yield self.assertFailure(d, KeyError)
+        self.assertEqual(self.presence.stats_expires_flushed, 0)
+
+    @defer.inlineCallbacks
+    def test_updateUnknownPresence(self):
+        r = yield self.presence.update('ivaxer@tipmeet.com', 'sip', 120)
+        self.assertEqual(r, None)
+
+    @defer.inlineCallbacks
+    def test_watchResource(self):
+        everything, ivaxer, both = [], [], []
+        self.presence.watch(lambda r, p: everything.append(r))
+        h1 = self.presence.watch(lambda r, p: ivaxer.append((r, p)), resource='ivaxer@tipmeet.com')
+        h2 = self.presence.watch(lambda r, p, l: l.append(r), both,
+                resource=['ivaxer@tipmeet.com', 'john@tipmeet.com'])
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', tag='sip')
+        yield self.presence.put('john@tipmeet.com', 'online', tag='sip')
+        yield self.presence.put('bob@tipmeet.com', 'online', tag='sip')
+        self.assertEqual(everything, ['ivaxer@tipmeet.com', 'john@tipmeet.com', 'bob@tipmeet.com'])
+        self.assertEqual(ivaxer, [('ivaxer@tipmeet.com', {'status': 'online'})])
+        self.assertEqual(both, ['ivaxer@tipmeet.com', 'john@tipmeet.com'])
+        self.presence.unwatch(h1)
+        self.presence.unwatch(h2)
+        self.presence.unwatch(h2)
+        self.assertEqual(self.presence._resource_watchers, {})
+        yield self.presence.remove('ivaxer@tipmeet.com', 'sip')
+        self.assertEqual(len(ivaxer), 1)
+        self.assertEqual(len(both), 2)
+        self.assertEqual(everything[-1], 'ivaxer@tipmeet.com')
+
+    @defer.inlineCallbacks
+    def test_passiveWatch(self):
+        passive = []
+        h = self.presence.watch(lambda r, p: passive.append(r), passive=True)
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', tag='sip')
+        self.assertEqual(passive, [])
+        self.presence.watch(lambda r, p: None, resource='john@tipmeet.com')
+        yield self.presence.put('ivaxer@tipmeet.com', 'offline', tag='sip')
+        yield self.presence.put('john@tipmeet.com', 'online', tag='sip')
+        self.assertEqual(passive, ['john@tipmeet.com'])
+        self.presence.unwatch(h)
+        self.assertEqual(self.presence._passive_callbacks, {})
+        yield self.presence.put('john@tipmeet.com', 'offline', tag='sip')
+        self.assertEqual(passive, ['john@tipmeet.com'])
+
+    @defer.inlineCallbacks
+    def test_removeLastTag(self):
+        self.presence.watch(lambda r, p: None)
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', tag='sip')
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', tag='http')
+        yield self.presence.remove('ivaxer@tipmeet.com', 'sip')
+        resources = yield self.storage.sgetall('resources')
+        self.assertEqual(set(resources), set(['ivaxer@tipmeet.com']))
+        self.assertIn('ivaxer@tipmeet.com', self.presence._notified_presence)
+        yield self.presence.remove('ivaxer@tipmeet.com', 'http')
+        resources = yield self.storage.sgetall('resources')
+        self.assertFalse(resources)
+        self.assertEqual(self.presence._notified_presence, {})
+
+    @defer.inlineCallbacks
+    def test_notifiedPresenceLimit(self):
+        self.presence.NOTIFIED_PRESENCE_LIMIT = 2
+        self.presence.watch(lambda r, p: None)
+        for user in ['ivaxer', 'john', 'bob']:
+            yield self.presence.put(user + '@tipmeet.com', 'online', tag='sip')
+        self.assertEqual(self.presence._notified_presence.keys(), ['john@tipmeet.com', 'bob@tipmeet.com'])
+        usage = self.presence.memoryUsage()
+        self.assertEqual(usage['notified_presence']['entries'], 2)
+        self.assertEqual(usage['expires_timers']['entries'], 3)
+        self.assertTrue(usage['expires_timers']['bytes'] > 0)
+
+    @defer.inlineCallbacks
+    def test_virtualClock(self):
+        clock = task.Clock()
+        presence = PresenceService(MemoryStorage(), clock=clock)
+        clock.advance(0)
+        yield presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        clock.advance(50)
+        yield presence.update('ivaxer@tipmeet.com', 'sip', 60)
+        clock.advance(50)
+        p = yield presence.get('ivaxer@tipmeet.com')
+        self.assertEqual(p, {'status': 'online'})
+        clock.advance(10)
+        p = yield presence.get('ivaxer@tipmeet.com')
+        self.assertEqual(p, None)
+        self.assertEqual(presence.stats_expired, 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_expireDuringRefresh(self):
+        clock = task.Clock()
+        presence = PresenceService(DelayedStorage(MemoryStorage(), clock, 0.01), clock=clock)
+        presence.EXPIRES_FLUSH_INTERVAL = 0
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='sip')
+        clock.advance(0.02)
+        clock.advance(9.975)
+        d = presence.update('ivaxer@tipmeet.com', 'sip', 60)
+        clock.pump([0.01] * 5)
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(presence.stats_expired, 0)
+        p = presence.get('ivaxer@tipmeet.com', 'sip')
+        clock.pump([0.01] * 5)
+        self.assertEqual(self.successResultOf(p)['expires'], 60)
+        clock.advance(60)
+        clock.pump([0.01] * 10)
+        self.assertEqual(presence.stats_expired, 1)
+        self.assertEqual(presence.stats_active_presence, 0)
+        self.assertEqual(len(presence._sequencer), 0)
+
+    def test_sequencing(self):
+        clock = task.Clock()
+        storage = MemoryStorage()
+        presence = PresenceService(DelayedStorage(storage, clock, 0.01), clock=clock)
+        d1 = presence.put('ivaxer@tipmeet.com', 'online', tag='sip')
+        d2 = presence.remove('ivaxer@tipmeet.com', 'sip')
+        d3 = presence.put('john@tipmeet.com', 'online', tag='sip')
+        clock.advance(0.01)
+        clock.advance(0.01)
+        self.assertEqual(self.successResultOf(d3), 'sip')
+        self.assertNoResult(d2)
+        clock.pump([0.01] * 10)
+        self.assertEqual(self.successResultOf(d1), 'sip')
+        self.assertEqual(self.successResultOf(d2), 1)
+        self.assertEqual(presence.stats_active_presence, 1)
+        self.assertEqual(presence._expires_timers.keys(), [('john@tipmeet.com', 'sip')])
+        self.assertEqual(self.successResultOf(storage.sgetall('resources')), set(['john@tipmeet.com']))
+        self.assertEqual(len(presence._sequencer), 0)
+
+    def test_queuedRefreshes(self):
+        clock = task.Clock()
+        presence = PresenceService(DelayedStorage(MemoryStorage(), clock, 0.01), clock=clock)
+        d1 = presence.put('ivaxer@tipmeet.com', 'online', expires=60, tag='sip')
+        updates = [presence.update('ivaxer@tipmeet.com', 'sip', 600) for i in xrange(3000)]
+        d2 = presence.remove('ivaxer@tipmeet.com', 'sip')
+        clock.pump([0.01] * 20)
+        self.assertEqual(self.successResultOf(d1), 'sip')
+        self.assertEqual(set(self.successResultOf(d) for d in updates), set([1]))
+        self.assertEqual(self.successResultOf(d2), 1)
+        self.assertEqual(len(presence._sequencer), 0)
+
+    @defer.inlineCallbacks
+    def test_putUnchanged(self):
+        notified = []
+        self.presence.watch(lambda r, p: notified.append(p))
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=60, priority=1, tag='sip', type='sip')
+        stored = yield self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        tag = yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=120, priority=1, tag='sip', type='sip')
+        self.assertEqual(tag, 'sip')
+        self.assertEqual(self.presence.stats_put_unchanged, 1)
+        s = yield self.storage.hgetall('presence:ivaxer@tipmeet.com:sip')
+        self.assertEqual(s, stored)
+        p = yield self.presence.get('ivaxer@tipmeet.com', 'sip')
+        self.assertEqual(p['expires'], 120)
+        yield self.presence.put('ivaxer@tipmeet.com', 'online', expires=120, priority=2, tag='sip', type='sip')
+        yield self.presence.put('ivaxer@tipmeet.com', 'offline', expires=120, priority=2, tag='sip', type='sip')
+        self.assertEqual(self.presence.stats_put_unchanged, 1)
+        self.assertEqual(notified, [{'status': 'online'}, {'status': 'offline'}])
+
+    @defer.inlineCallbacks
+    def test_recoverExpireTimers(self):
+        storage = MemoryStorage()
+        presence = PresenceService(storage, clock=task.Clock())
+        for i in xrange(20):
+            yield presence.put('user%d@tipmeet.com' % i, 'online', expires=60, tag='sip')
+        clock = task.Clock()
+        presence = PresenceService(DelayedStorage(storage, clock, 1), clock=clock)
+        ready = presence.whenReady()
+        yield task.deferLater(reactor, 0, lambda: None)
+        # a few storage round trips for all resources, not a few per resource
+        clock.pump([1] * 5)
+        self.successResultOf(ready)
+        self.assertEqual(len(presence._expires_timers), 20)
+        self.assertEqual(presence.stats_active_presence, 20)
+        self.assertIn('presence_timer_recovery', utils.startup_timings.dump())
+
+    @defer.inlineCallbacks
+    def test_recoverFailure(self):
+        storage = MemoryStorage()
+        storage.sgetall = lambda key: defer.fail(IOError("connection lost"))
+        presence = PresenceService(storage, clock=task.Clock())
+        yield self.assertFailure(presence.whenReady(), IOError)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        yield self.assertFailure(presence.whenReady(), IOError)
+
+    @defer.inlineCallbacks
+    def test_recoverUnflushedRefresh(self):
+        storage = MemoryStorage()
+        clock = task.Clock()
+        presence = PresenceService(storage, clock=clock)
+        yield presence.put('ivaxer@tipmeet.com', 'online', expires=3600, tag='sip')
+        clock.advance(3000)
+        yield presence.update('ivaxer@tipmeet.com', 'sip', 3600)
+        clock.advance(10)
+        # crash without flushExpires(): the refresh is lost from storage
+        for call in clock.getDelayedCalls():
+            call.cancel()
+        presence = PresenceService(storage, clock=clock)
+        yield presence.whenReady()
+        clock.advance(3589)
+        p = yield presence.get('ivaxer@tipmeet.com', 'sip')
+        self.assertEqual(p['expires_at'], 6610)
+        clock.advance(11)
+        self.assertEqual(presence.stats_expired, 1)
+
+    def test_ttlExpiry(self):
+        clock = task.Clock()
+        storage = TTLMemoryStorage(clock)
+        presence = PresenceService(storage, clock=clock, ttl_expiry=True)
+        notified = []
+        presence.watch(lambda r, p: notified.append(p))
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='sip')
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='http')
+        self.assertEqual(presence._expires_timers, {})
+        clock.advance(5)
+        self.assertEqual(self.successResultOf(presence.update('ivaxer@tipmeet.com', 'sip', 20)), 1)
+        clock.advance(5)
+        self.assertEqual(presence.stats_expired, 1)
+        self.assertEqual(self.successResultOf(presence.get('ivaxer@tipmeet.com', 'http')), None)
+        self.assertEqual(self.successResultOf(presence.get('ivaxer@tipmeet.com')), {'status': 'online'})
+        clock.advance(15)
+        self.assertEqual(presence.stats_expired, 2)
+        self.assertEqual(self.successResultOf(presence.get('ivaxer@tipmeet.com')), None)
+        self.assertFalse(self.successResultOf(storage.sgetall('resources')))
+        self.assertEqual(notified, [{'status': 'online'}, None])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_ttlPutNewTag(self):
+        clock = task.Clock()
+        storage = TTLMemoryStorage(clock)
+        reads = []
+        hgetall = storage.hgetall
+        storage.hgetall = lambda key: reads.append(key) or hgetall(key)
+        presence = PresenceService(storage, clock=clock, ttl_expiry=True)
+        tag = self.successResultOf(presence.put('ivaxer@tipmeet.com', 'online', expires=10))
+        self.assertEqual(reads, [])
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag=tag)
+        self.assertEqual(reads, ['presence:ivaxer@tipmeet.com:%s' % tag])
+        self.assertEqual(presence.stats_put_unchanged, 1)
+
+    def test_ttlExpiryRemove(self):
+        clock = task.Clock()
+        storage = TTLMemoryStorage(clock)
+        presence = PresenceService(storage, clock=clock, ttl_expiry=True)
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='sip')
+        self.assertEqual(self.successResultOf(presence.remove('ivaxer@tipmeet.com', 'sip')), 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='sip')
+        presence._keyExpired('presence:ivaxer@tipmeet.com:sip')
+        self.assertEqual(presence.stats_expired, 0)
+        self.assertEqual(self.successResultOf(presence.get('ivaxer@tipmeet.com')), {'status': 'online'})
+
+    def test_ttlExpiryMissingSet(self):
+        clock = task.Clock()
+        storage = TTLMemoryStorage(clock)
+        sgetall = storage.sgetall
+        def strict_sgetall(key):
+            # backends that raise KeyError for missing sets, like for missing hashes
+            def check(members):
+                if not members:
+                    raise KeyError(key)
+                return members
+            return sgetall(key).addCallback(check)
+        storage.sgetall = strict_sgetall
+        presence = PresenceService(storage, clock=clock, ttl_expiry=True)
+        presence.put('ivaxer@tipmeet.com', 'online', expires=10, tag='sip')
+        self.assertEqual(self.successResultOf(presence.remove('ivaxer@tipmeet.com', 'sip')), 1)
+        self.assertEqual(self.successResultOf(presence._keyExpired('presence:ivaxer@tipmeet.com:sip')), None)
+        self.assertEqual(presence.stats_expired, 0)
@@ -0,0 +1,33 @@
+from twisted.trial import unittest
+
+from tippresence.simulation import Simulation, VirtualClock
+
+class VirtualClockTest(unittest.TestCase):
+    def test_callLater(self):
+        clock = VirtualClock()
+        calls = []
+        c1 = clock.callLater(10, calls.append, 1)
+        c2 = clock.callLater(5, calls.append, 2)
+        c3 = clock.callLater(7, calls.append, 3)
+        c2.reset(20)
+        c3.cancel()
+        clock.advance(10)
+        self.assertEqual(calls, [1])
+        self.assertFalse(c1.active())
+        self.assertEqual(clock.getDelayedCalls(), [c2])
+        clock.advance(15)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(clock.active, 0)
+        self.assertEqual(clock.peak_active, 3)
+
+class SimulationTest(unittest.TestCase):
+    def test_deterministic(self):
+        r1 = Simulation(resources=50, tags=2, expires=600, flap=0.1, drop=0.1, away=600, seed=1).run(days=0.25)
+        r2 = Simulation(resources=50, tags=2, expires=600, flap=0.1, drop=0.1, away=600, seed=1).run(days=0.25)
+        for k in ['cpu_seconds', 'wall_seconds', 'peak_rss_kb']:
+            del r1[k], r2[k]
+        self.assertEqual(r1, r2)
+        self.assertEqual(r1['virtual_seconds'], 0.25 * 86400)
+        self.assertEqual(r1['peak_presence_timers'], 100)
+        self.assertTrue(r1['expired'] > 0)
+        self.assertTrue(r1['notifications'] > r1['expired'])
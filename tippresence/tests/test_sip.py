@@ -0,0 +1,309 @@
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+from StringIO import StringIO
+
+from tipsip import MemoryStorage, SIPError
+from tippresence import PresenceService
+from tippresence.storage import TTLMemoryStorage
+from tippresence.sip.presence import SIPPresence, presence2rlmi, list2multipart, RLMI_BOUNDARY
+from tippresence.http import HTTPResourceLists
+
+class ResourceListTest(unittest.TestCase):
+    def test_rlmi(self):
+        rlmi = presence2rlmi('buddies@tipmeet.com', 3, False, ['ivaxer@tipmeet.com'])
+        self.assertIn('uri="sip:buddies@tipmeet.com" version="3" fullState="false"', rlmi)
+        self.assertIn('<resource uri="sip:ivaxer@tipmeet.com">', rlmi)
+        self.assertIn('cid="ivaxer@tipmeet.com"', rlmi)
+
+    def test_multipart(self):
+        presence_list = [('ivaxer@tipmeet.com', {'status': 'online'}), ('john@tipmeet.com', None)]
+        body = list2multipart('buddies@tipmeet.com', 0, True, presence_list)
+        parts = body.split('--' + RLMI_BOUNDARY)
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--')
+        self.assertEqual(len(parts), 5)
+        self.assertIn('Content-ID: <buddies@tipmeet.com>', parts[1])
+        self.assertIn('Content-Type: application/rlmi+xml', parts[1])
+        self.assertIn('Content-ID: <ivaxer@tipmeet.com>', parts[2])
+        self.assertIn('<basic>open</basic>', parts[2])
+        self.assertIn('<basic>closed</basic>', parts[3])
+
+
+class Headers(dict):
+    def __init__(self, headers=None):
+        dict.__init__(self)
+        for k, v in (headers or {}).iteritems():
+            self[k] = v
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class FakeURI(object):
+    def __init__(self, resource):
+        self.user, self.host = resource.split('@')
+
+
+class FakeMessage(object):
+    def __init__(self, method, headers=None, content=None):
+        self.method = method
+        self.headers = Headers(headers)
+        self.content = content
+
+
+class FakeSubscribe(FakeMessage):
+    def __init__(self, resource, expires, headers=None, dialog=None):
+        h = {'Event': 'presence', 'Expires': str(expires)}
+        h.update(headers or {})
+        FakeMessage.__init__(self, 'SUBSCRIBE', h)
+        self.ruri = FakeURI(resource)
+        self.dialog = dialog
+        self.has_totag = dialog is not None
+
+    def createResponse(self, code, reason):
+        response = FakeMessage(None)
+        response.code = code
+        response.reason = reason
+        return response
+
+
+class FakeDialog(object):
+    def __init__(self, id):
+        self.id = id
+
+    def createRequest(self, method):
+        return FakeMessage(method)
+
+
+class FakeDialogStore(object):
+    def __init__(self):
+        self.dialogs = {}
+
+    def get(self, id):
+        return defer.succeed(self.dialogs.get(id))
+
+
+class FakeSIPPresence(SIPPresence):
+    """SIPPresence with transactions and dialogs replaced by in-memory fakes."""
+
+    def __init__(self, *args, **kwargs):
+        SIPPresence.__init__(self, *args, **kwargs)
+        self.requests = []
+        self.responses = []
+        self._dialog_seq = 0
+
+    def sendRequest(self, request):
+        self.requests.append(request)
+        return defer.succeed(None)
+
+    def sendResponse(self, response):
+        self.responses.append(response)
+
+    def createDialog(self, request):
+        self._dialog_seq += 1
+        request.dialog = FakeDialog(('call%d' % self._dialog_seq, 'from', 'to'))
+        self.dialog_store.dialogs[request.dialog.id] = request.dialog
+        return defer.succeed(request.dialog)
+
+    def removeDialog(self, id):
+        self.dialog_store.dialogs.pop(id, None)
+        return defer.succeed(None)
+
+
+class SIPPresenceTestBase(unittest.TestCase):
+    ttl_expiry = False
+
+    def setUp(self):
+        self.clock = task.Clock()
+        if self.ttl_expiry:
+            self.storage = TTLMemoryStorage(self.clock)
+        else:
+            self.storage = MemoryStorage()
+        self.presence = PresenceService(self.storage, clock=self.clock, ttl_expiry=self.ttl_expiry)
+        self.dialog_store = FakeDialogStore()
+        self.sip = FakeSIPPresence(self.storage, self.dialog_store, None, None, self.presence, clock=self.clock)
+        return task.deferLater(reactor, 0, lambda: None)
+
+    def subscribe(self, resource, expires=60, headers=None, dialog=None):
+        subscribe = FakeSubscribe(resource, expires, headers, dialog)
+        d = self.sip.handle_SUBSCRIBE(subscribe)
+        self.successResultOf(d)
+        return subscribe
+
+    def lastNotify(self):
+        notify = self.sip.requests[-1]
+        self.assertEqual(notify.method, 'NOTIFY')
+        return notify
+
+
+class SIPPresenceTest(SIPPresenceTestBase):
+
+    def test_subscribe(self):
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        subscribe = self.subscribe('ivaxer@tipmeet.com')
+        self.assertEqual(self.sip.responses[-1].code, 200)
+        notify = self.lastNotify()
+        self.assertEqual(str(notify.headers['subscription-state']), 'active;expires=60')
+        self.assertIn('<basic>open</basic>', notify.content)
+        self.assertEqual(self.sip._watched_resources.keys(), ['ivaxer@tipmeet.com'])
+
+        self.presence.put('ivaxer@tipmeet.com', 'offline', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 2)
+        self.assertIn('<basic>closed</basic>', self.lastNotify().content)
+
+        self.subscribe('ivaxer@tipmeet.com', 120, dialog=subscribe.dialog)
+        self.assertEqual(len(self.sip.requests), 3)
+        self.assertEqual(str(self.lastNotify().headers['subscription-state']), 'active;expires=120')
+
+        self.subscribe('ivaxer@tipmeet.com', 0, dialog=subscribe.dialog)
+        self.assertEqual(str(self.lastNotify().headers['subscription-state']), 'terminated;expires=0')
+        self.assertEqual(self.sip._watched_resources, {})
+        self.assertEqual(self.dialog_store.dialogs, {})
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 4)
+
+    def test_watcherExpires(self):
+        subscribe = self.subscribe('ivaxer@tipmeet.com')
+        self.clock.advance(91)
+        self.assertEqual(self.dialog_store.dialogs, {})
+        self.assertEqual(self.sip._watched_resources, {})
+        self.assertFalse(self.successResultOf(self.sip._hasWatcher(subscribe.dialog.id)))
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 1)
+
+    def test_listRequiresEventlist(self):
+        self.successResultOf(self.sip.setResourceList('buddies@tipmeet.com', ['ivaxer@tipmeet.com']))
+        d = self.sip.handle_SUBSCRIBE(FakeSubscribe('buddies@tipmeet.com', 60))
+        f = self.failureResultOf(d, SIPError)
+        self.assertEqual(f.value.code, 421)
+        self.assertEqual(self.sip.requests, [])
+
+    def test_listNotify(self):
+        members = ['ivaxer@tipmeet.com', 'john@tipmeet.com', 'bob@tipmeet.com']
+        self.successResultOf(self.sip.setResourceList('buddies@tipmeet.com', members))
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        subscribe = self.subscribe('buddies@tipmeet.com', headers={'Supported': 'eventlist'})
+        notify = self.lastNotify()
+        self.assertEqual(notify.headers['require'], 'eventlist')
+        self.assertIn('version="0" fullState="true"', notify.content)
+        for member in members:
+            self.assertIn('Content-ID: <%s>' % member, notify.content)
+
+        self.presence.put('john@tipmeet.com', 'online', expires=600, tag='sip')
+        self.presence.put('ivaxer@tipmeet.com', 'offline', expires=600, tag='sip')
+        self.presence.put('john@tipmeet.com', 'offline', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 1)
+        self.clock.advance(self.sip.LIST_NOTIFY_INTERVAL)
+        self.assertEqual(len(self.sip.requests), 2)
+        notify = self.lastNotify()
+        self.assertIn('version="1" fullState="false"', notify.content)
+        self.assertIn('Content-ID: <ivaxer@tipmeet.com>', notify.content)
+        self.assertIn('Content-ID: <john@tipmeet.com>', notify.content)
+        self.assertNotIn('Content-ID: <bob@tipmeet.com>', notify.content)
+
+        self.subscribe('buddies@tipmeet.com', 60, dialog=subscribe.dialog)
+        notify = self.lastNotify()
+        self.assertIn('version="2" fullState="true"', notify.content)
+        self.assertIn('Content-ID: <bob@tipmeet.com>', notify.content)
+
+    def test_listMembershipChange(self):
+        self.successResultOf(self.sip.setResourceList('buddies@tipmeet.com', ['ivaxer@tipmeet.com']))
+        self.presence.put('john@tipmeet.com', 'online', expires=600, tag='sip')
+        self.subscribe('buddies@tipmeet.com', headers={'Supported': 'eventlist'})
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        members = ['ivaxer@tipmeet.com', 'john@tipmeet.com']
+        self.successResultOf(self.sip.setResourceList('buddies@tipmeet.com', members))
+        self.assertEqual(len(self.sip.requests), 2)
+        notify = self.lastNotify()
+        self.assertIn('version="1" fullState="true"', notify.content)
+        self.assertIn('Content-ID: <john@tipmeet.com>', notify.content)
+        self.assertEqual(notify.content.count('<basic>open</basic>'), 2)
+        # the full state NOTIFY covered the pending change
+        self.clock.advance(self.sip.LIST_NOTIFY_INTERVAL)
+        self.assertEqual(len(self.sip.requests), 2)
+        self.successResultOf(self.sip.setResourceList('buddies@tipmeet.com', members))
+        self.assertEqual(len(self.sip.requests), 2)
+        self.presence.put('john@tipmeet.com', 'offline', expires=600, tag='sip')
+        self.clock.advance(self.sip.LIST_NOTIFY_INTERVAL)
+        self.assertEqual(len(self.sip.requests), 3)
+        self.assertIn('version="2" fullState="false"', self.lastNotify().content)
+
+    def test_listProvisioning(self):
+        http = HTTPResourceLists(self.sip, {'guest': 'guest'})
+
+        def request(method, path, body='', user='guest'):
+            request = DummyRequest(path)
+            request.method = method
+            request.content = StringIO(body)
+            request.getUser = lambda: user
+            request.getPassword = lambda: 'guest'
+            result = http.render(request)
+            if isinstance(result, str):
+                return json.loads(result)
+            return json.loads(''.join(request.written))
+
+        body = json.dumps(['ivaxer@tipmeet.com', 'john@tipmeet.com'])
+        r = request('PUT', ['buddies@tipmeet.com'], body, user=None)
+        self.assertEqual(r['reason'], 'Authentication required')
+        r = request('PUT', ['buddies@tipmeet.com'], json.dumps({'a': 1}))
+        self.assertEqual(r['status'], 'failure')
+        r = request('PUT', ['buddies@tipmeet.com'], body)
+        self.assertEqual(r['status'], 'ok')
+        r = request('GET', ['buddies@tipmeet.com'])
+        self.assertEqual(r['result'], ['ivaxer@tipmeet.com', 'john@tipmeet.com'])
+        self.subscribe('buddies@tipmeet.com', headers={'Supported': 'eventlist'})
+        self.assertEqual(self.lastNotify().headers['require'], 'eventlist')
+        r = request('DELETE', ['buddies@tipmeet.com'])
+        self.assertEqual(r['status'], 'ok')
+        r = request('GET', ['buddies@tipmeet.com'])
+        self.assertEqual(r['reason'], 'Not Found')
+        self.assertEqual(self.sip._watched_resources.keys(), [])
+
+    def test_sharedResourceWatch(self):
+        s1 = self.subscribe('ivaxer@tipmeet.com')
+        s2 = self.subscribe('ivaxer@tipmeet.com')
+        self.assertEqual(self.sip._watched_resources['ivaxer@tipmeet.com'][1], 2)
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 4)
+        self.subscribe('ivaxer@tipmeet.com', 0, dialog=s1.dialog)
+        self.assertEqual(self.sip._watched_resources['ivaxer@tipmeet.com'][1], 1)
+        self.presence.put('ivaxer@tipmeet.com', 'offline', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 6)
+        self.assertEqual(self.sip.requests[-1].content.count('<basic>closed</basic>'), 1)
+        self.subscribe('ivaxer@tipmeet.com', 0, dialog=s2.dialog)
+        self.assertEqual(self.sip._watched_resources, {})
+
+
+class SIPPresenceTTLTest(SIPPresenceTestBase):
+    ttl_expiry = True
+
+    def test_watcherExpires(self):
+        subscribe = self.subscribe('ivaxer@tipmeet.com')
+        self.clock.advance(91)
+        self.assertEqual(self.dialog_store.dialogs, {})
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 1)
+
+    def test_staleWatcher(self):
+        subscribe = self.subscribe('ivaxer@tipmeet.com')
+        watcher = subscribe.dialog.id
+        # watcher TTL key expires while nobody listens for expiry events
+        self.storage._expired_callbacks = []
+        self.clock.advance(91)
+        self.assertIn(watcher, self.dialog_store.dialogs)
+        self.presence.put('ivaxer@tipmeet.com', 'online', expires=600, tag='sip')
+        self.assertEqual(len(self.sip.requests), 1)
+        self.assertEqual(self.dialog_store.dialogs, {})
+        self.assertFalse(self.successResultOf(self.storage.sgetall('sys:watchers_by_resource:ivaxer@tipmeet.com')))
+        self.failureResultOf(self.storage.hget(self.sip.WATCHER_TIMERS, ':'.join(watcher)), KeyError)
+        d = self.sip.handle_SUBSCRIBE(FakeSubscribe('ivaxer@tipmeet.com', 60, dialog=subscribe.dialog))
+        self.assertEqual(self.failureResultOf(d, SIPError).value.code, 500)
@@ -0,0 +1,84 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+import json
+from StringIO import StringIO
+
+from tipsip import MemoryStorage
+from tippresence import PresenceService
+from tippresence.http import HTTPPresence
+from tippresence.trace import TraceWriter, read_trace, OP_PUT, OP_UPDATE, OP_REMOVE
+from tippresence.replay import Replay
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.f = StringIO()
+        self.trace = TraceWriter(self.f, clock=self.clock)
+        self.presence = PresenceService(MemoryStorage(), clock=self.clock)
+        self.http = HTTPPresence(self.presence, trace=self.trace)
+
+    def request(self, method, path, body='', args=None):
+        request = DummyRequest(path)
+        request.method = method
+        request.content = StringIO(body)
+        request.args = args or {}
+        self.http.render(request)
+        return json.loads(''.join(request.written))
+
+    def records(self):
+        return list(read_trace(StringIO(self.f.getvalue())))
+
+    def test_roundtrip(self):
+        self.trace.record(OP_PUT, 1.5, ['ivaxer@tipmeet.com', 'online', {'expires': 60}], 'tag')
+        self.trace.record(OP_REMOVE, 2.5, ['ivaxer@tipmeet.com', 'tag'], {'error': 'Not Found'})
+        self.assertEqual(self.records(), [
+            (1.5, OP_PUT, ['ivaxer@tipmeet.com', 'online', {'expires': 60}], 'tag'),
+            (2.5, OP_REMOVE, ['ivaxer@tipmeet.com', 'tag'], {'error': 'Not Found'})])
+        self.f.truncate(len(self.f.getvalue()) - 3)
+        self.assertEqual(len(self.records()), 1)
+
+    def test_capture(self):
+        body = json.dumps({'presence': {'status': 'online'}, 'expires': 60})
+        r = self.request('PUT', ['ivaxer@tipmeet.com'], body)
+        tag = r['result']['tag']
+        self.clock.advance(10)
+        self.request('POST', ['ivaxer@tipmeet.com', tag, 'refresh'], args={'expires': ['120']})
+        self.request('POST', ['ivaxer@tipmeet.com', 'gone', 'refresh'])
+        self.request('DELETE', ['ivaxer@tipmeet.com', tag])
+        records = self.records()
+        self.assertEqual([(ts, op) for ts, op, args, result in records],
+                [(0, OP_PUT), (10, OP_UPDATE), (10, OP_UPDATE), (10, OP_REMOVE)])
+        self.assertEqual(records[1][2:], ([u'ivaxer@tipmeet.com', tag, 120], 1))
+        self.assertFalse(records[2][3])
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        body = json.dumps({'presence': {'status': 'online'}, 'expires': 60})
+        r = self.request('PUT', ['ivaxer@tipmeet.com'], body)
+        tag = r['result']['tag']
+        self.request('POST', ['ivaxer@tipmeet.com', tag, 'refresh'], args={'expires': ['120']})
+        self.request('DELETE', ['ivaxer@tipmeet.com', tag])
+        # replayed untagged put gets a fresh tag, later ops must follow it
+        service = PresenceService(MemoryStorage(), clock=task.Clock())
+        report = yield Replay(self.records(), service).run()
+        self.assertEqual(report['operations'], 3)
+        self.assertEqual(report['divergences'], 0)
+        # state differs from the capture: the update hits a missing presence
+        service = PresenceService(MemoryStorage(), clock=task.Clock())
+        report = yield Replay(self.records()[1:], service).run()
+        self.assertEqual(report['divergences'], 2)
+
+    @defer.inlineCallbacks
+    def test_replayTaggedPut(self):
+        body = json.dumps({'presence': {'status': 'online'}, 'expires': 60})
+        tag = self.request('PUT', ['ivaxer@tipmeet.com'], body)['result']['tag']
+        body = json.dumps({'presence': {'status': 'offline'}, 'expires': 60})
+        self.request('PUT', ['ivaxer@tipmeet.com', tag], body)
+        service = PresenceService(MemoryStorage(), clock=task.Clock())
+        report = yield Replay(self.records(), service).run()
+        self.assertEqual(report['divergences'], 0)
+        presence = yield service.get('ivaxer@tipmeet.com', aggregated=False)
+        self.assertEqual(len(presence), 1)
+        self.assertEqual(presence[0]['status'], 'offline')
@@ -0,0 +1,48 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from tippresence.utils import KeySequencer
+
+class KeySequencerTest(unittest.TestCase):
+    def test_sequence(self):
+        seq = KeySequencer()
+        calls = []
+        pending = []
+        def op(name):
+            calls.append(name)
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        d1 = seq.run('a', op, 'a1')
+        d2 = seq.run('a', op, 'a2')
+        d3 = seq.run('b', op, 'b1')
+        self.assertEqual(calls, ['a1', 'b1'])
+        self.assertEqual(len(seq), 2)
+        pending.pop(0).callback(1)
+        self.assertEqual(self.successResultOf(d1), 1)
+        self.assertEqual(calls, ['a1', 'b1', 'a2'])
+        pending.pop().errback(ValueError())
+        self.failureResultOf(d2, ValueError)
+        self.assertNotIn('a', seq)
+        pending.pop().callback(3)
+        self.assertEqual(self.successResultOf(d3), 3)
+        self.assertEqual(len(seq), 0)
+
+    def test_idleKey(self):
+        seq = KeySequencer()
+        self.assertEqual(self.successResultOf(seq.run('a', lambda: 1)), 1)
+        self.failureResultOf(seq.run('a', lambda: 1 / 0), ZeroDivisionError)
+        self.assertEqual(len(seq), 0)
+
+    def test_longSynchronousQueue(self):
+        seq = KeySequencer()
+        first = defer.Deferred()
+        seq.run('a', lambda: first)
+        ds = [seq.run('a', lambda i=i: i) for i in xrange(5000)]
+        ds.append(seq.run('a', lambda: 1 / 0))
+        last = seq.run('a', lambda: 'last')
+        first.callback(None)
+        self.assertEqual([self.successResultOf(d) for d in ds[:-1]], range(5000))
+        self.failureResultOf(ds[-1], ZeroDivisionError)
+        self.assertEqual(self.successResultOf(last), 'last')
+        self.assertEqual(len(seq), 0)
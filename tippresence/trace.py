@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Compact binary traces of presence operations.
+
+A trace starts with MAGIC and holds one record per operation:
+
+    !dBI header (start timestamp, op code, payload length) + JSON payload
+
+The payload is [args, result], see OPS for the arguments of every op.
+Records are written when the operation completes, so they are ordered by
+completion, not by start time.
+"""
+
+import json
+import struct
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+
+MAGIC = 'TPTRACE1'
+HEADER = struct.Struct('!dBI')
+
+OP_PUT = 1              # [resource, status, kw]
+OP_UPDATE = 2           # [resource, tag, expires]
+OP_REMOVE = 3           # [resource, tag]
+OP_BULK_PUT = 4         # [[resource, status, kw], ...]
+OP_BULK_UPDATE = 5      # [[resource, tag, expires], ...]
+OP_SUBSCRIBE = 6        # [watcher, resource or None for refresh, expires]; expires 0 unsubscribes
+
+OPS = {
+    OP_PUT: 'put',
+    OP_UPDATE: 'update',
+    OP_REMOVE: 'remove',
+    OP_BULK_PUT: 'bulk_put',
+    OP_BULK_UPDATE: 'bulk_update',
+    OP_SUBSCRIBE: 'subscribe',
+}
+
+def _failureResult(failure):
+    return {'error': failure.getErrorMessage()}
+
+class TraceWriter(object):
+    def __init__(self, f, clock=None):
+        if isinstance(f, basestring):
+            f = open(f, 'wb')
+        self.f = f
+        self.clock = clock or reactor
+        self.records = 0
+        self.f.write(MAGIC)
+
+    def record(self, op, ts, args, result):
+        payload = json.dumps([args, result], separators=(',', ':'))
+        self.f.write(HEADER.pack(ts, op, len(payload)))
+        self.f.write(payload)
+        self.records += 1
+
+    def capture(self, d, op, args):
+        """Record op with its result once Deferred d fires. Returns d unchanged."""
+        ts = self.clock.seconds()
+        def recordResult(result):
+            self.record(op, ts, args, result)
+            return result
+        def recordFailure(failure):
+            self.record(op, ts, args, _failureResult(failure))
+            return failure
+        d.addCallbacks(recordResult, recordFailure)
+        return d
+
+    def captureList(self, dl, op, args):
+        """Record op with the results of all Deferreds in dl once they fire.
+
+        Call it after the caller has attached its own handling to dl, the
+        failures are consumed here.
+        """
+        ts = self.clock.seconds()
+        def recordResults(results):
+            result = [r if success else _failureResult(r) for success, r in results]
+            self.record(op, ts, args, result)
+        defer.DeferredList(dl, consumeErrors=True).addCallback(recordResults)
+
+    def close(self):
+        self.f.close()
+
+
+def read_trace(f):
+    """Yield (ts, op, args, result) records of a trace file."""
+    if isinstance(f, basestring):
+        f = open(f, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a presence trace")
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            if header:
+                log.msg("TRACE | Truncated record at the end of trace.")
+            break
+        ts, op, size = HEADER.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size:
+            log.msg("TRACE | Truncated record at the end of trace.")
+            break
+        args, result = json.loads(payload)
+        yield ts, op, args, result
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import time
+from collections import OrderedDict, deque
+from itertools import islice
 from random import choice
 from string import ascii_letters
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.python import failure
 
 def random_str(len):
     return "".join(choice(ascii_letters) for x in xrange(len))
@@ -12,3 +17,148 @@ def presence_keyf(status):
     priority = status['priority']
     presence_status = 1 if status['status'] == 'online' else 0
     return 2 * priority + presence_status
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(sys.getsizeof(x) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in obj.iteritems())
+    return size
+
+def container_usage(container, sample=1000):
+    """Return number of entries and estimated bytes of a dict or set.
+
+    Entry sizes are measured on at most `sample` entries and extrapolated.
+    """
+    entries = len(container)
+    size = sys.getsizeof(container)
+    if entries:
+        if isinstance(container, dict):
+            items = islice(container.iteritems(), sample)
+        else:
+            items = ((x, None) for x in islice(container, sample))
+        measured = 0
+        n = 0
+        for k, v in items:
+            measured += _sizeof(k) + (_sizeof(v) if v is not None else 0)
+            n += 1
+        size += measured * entries // n
+    return {'entries': entries, 'bytes': size}
+
+class KeySequencer(object):
+    """Run operations one by one per key, operations on different keys concurrently.
+
+    An idle key runs the operation right away; callers arriving while it is
+    busy are queued in `locks` and started when the previous operation is done.
+    """
+
+    def __init__(self):
+        self.locks = {}
+
+    def __contains__(self, key):
+        return key in self.locks
+
+    def __len__(self):
+        return len(self.locks)
+
+    def run(self, key, f, *args, **kwargs):
+        d = defer.Deferred()
+        waiting = self.locks.get(key)
+        if waiting is None:
+            self.locks[key] = deque([(d, f, args, kwargs)])
+            self._drain(key)
+        else:
+            waiting.append((d, f, args, kwargs))
+        return d
+
+    def _drain(self, key):
+        # operations that finish synchronously are run in a loop, not by
+        # recursion from their callbacks, so a long queue can't blow the stack
+        waiting = self.locks[key]
+        while waiting:
+            d, f, args, kwargs = waiting.popleft()
+            results = []
+            result = defer.maybeDeferred(f, *args, **kwargs)
+            result.addBoth(results.append)
+            if not results:
+                # still running, the rest of the queue is drained when it is done
+                result.addCallback(self._resume, results, d, key)
+                return
+            self._fire(d, results[0])
+        del self.locks[key]
+
+    def _resume(self, _, results, d, key):
+        self._fire(d, results[0])
+        self._drain(key)
+
+    def _fire(self, d, result):
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+class ReadyEvent(object):
+    """One-shot event, any number of waiters get a Deferred fired when it happens."""
+
+    def __init__(self):
+        self.fired = False
+        self.failure = None
+        self._waiters = []
+
+    def wait(self):
+        if self.fired:
+            if self.failure:
+                return defer.fail(self.failure)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def fire(self):
+        self._fire(None)
+
+    def fail(self, failure):
+        self._fire(failure)
+
+    def _fire(self, failure):
+        if self.fired:
+            return
+        self.fired = True
+        self.failure = failure
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            if failure:
+                d.errback(failure)
+            else:
+                d.callback(None)
+
+class StartupTimings(object):
+    """Start offsets and durations of startup phases, in wall clock seconds."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = OrderedDict()
+
+    def start(self, name):
+        self.phases[name] = [time.time(), None]
+
+    def finish(self, name):
+        phase = self.phases.get(name)
+        if phase and phase[1] is None:
+            phase[1] = time.time()
+
+    def mark(self, name):
+        self.start(name)
+        self.finish(name)
+
+    def dump(self):
+        r = OrderedDict()
+        for name, (start, end) in self.phases.iteritems():
+            r[name] = {
+                'started_at': round(start - self.started, 3),
+                'seconds': round(end - start, 3) if end is not None else None,
+            }
+        return r
+
+startup_timings = StartupTimings()